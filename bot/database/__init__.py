@@ -1,6 +1,4 @@
-from .models import User, Message, Summarization, Base
-from .session import get_session, init_db, engine
-
-__all__ = ['User', 'Message', 'Summarization', 'Base', 'get_session', 'init_db', 'engine']
-
+from .models import User, Message, Summarization, OnboardingAnswer, Transcript, Base
+from .session import get_session, get_read_session, init_db, optimize_db, engine
 
+__all__ = ['User', 'Message', 'Summarization', 'OnboardingAnswer', 'Transcript', 'Base', 'get_session', 'get_read_session', 'init_db', 'optimize_db', 'engine']
@@ -1,6 +1,8 @@
 import logging
-from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, ForeignKey, Enum as SQLEnum
+from operator import attrgetter
+from types import MappingProxyType
+from sqlalchemy import Column, BigInteger, Integer, String, Text, DateTime, Boolean, ForeignKey, Index, Enum as SQLEnum, text
+from sqlalchemy.sql import func
 from sqlalchemy.orm import declarative_base, relationship
 import enum
 
@@ -8,6 +10,19 @@ logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# Sphere -> selected curator column, shared by User and the cached user snapshot
+_CURATOR_GETTERS = MappingProxyType({
+    "business": attrgetter("selected_business"),
+    "soul": attrgetter("selected_soul"),
+    "body": attrgetter("selected_body"),
+    "center": attrgetter("selected_center")
+})
+
+# UTC timestamps computed by SQLite itself. CURRENT_TIMESTAMP only has second
+# precision, which is too coarse to order messages against summarizations.
+UTC_NOW_SQL = func.strftime("%Y-%m-%d %H:%M:%f", "now")
+UTC_NOW_DDL = text("(strftime('%Y-%m-%d %H:%M:%f', 'now'))")
+
 
 class Sphere(enum.Enum):
     CENTER = "center"
@@ -20,7 +35,8 @@ class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, nullable=False, index=True)
+    # Telegram ids exceed 2**31; BIGINT keeps INTEGER affinity in SQLite
+    telegram_id = Column(BigInteger, unique=True, nullable=False, index=True)
     username = Column(String(255), nullable=True)
     first_name = Column(String(255), nullable=True)
     last_name = Column(String(255), nullable=True)
@@ -28,7 +44,7 @@ class User(Base):
     # Onboarding state
     is_onboarding = Column(Boolean, default=True)
     onboarding_step = Column(Integer, default=0)
-    onboarding_answers = Column(Text, default="")  # JSON string of answers
+    onboarding_answers = Column(Text, default="")  # Legacy JSON string of answers, see OnboardingAnswer
     
     # Psychotype result
     psychotype = Column(Text, nullable=True)
@@ -46,19 +62,39 @@ class User(Base):
     selected_center = Column(String(50), nullable=True)
     
     # Thread IDs for sphere detection
-    chat_id = Column(Integer, nullable=True)
-    thread_soul = Column(Integer, nullable=True)
-    thread_body = Column(Integer, nullable=True)
-    thread_business = Column(Integer, nullable=True)
-    thread_center = Column(Integer, nullable=True)
+    chat_id = Column(BigInteger, nullable=True)
+    thread_soul = Column(BigInteger, nullable=True)
+    thread_body = Column(BigInteger, nullable=True)
+    thread_business = Column(BigInteger, nullable=True)
+    thread_center = Column(BigInteger, nullable=True)
     
     # Timestamps
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = Column(DateTime, default=UTC_NOW_SQL, server_default=UTC_NOW_DDL)
+    updated_at = Column(DateTime, default=UTC_NOW_SQL, server_default=UTC_NOW_DDL, onupdate=UTC_NOW_SQL)
     
     # Relationships
-    messages = relationship("Message", back_populates="user", cascade="all, delete-orphan")
-    summarizations = relationship("Summarization", back_populates="user", cascade="all, delete-orphan")
+    # Never lazy-load: callers that need these must ask for selectinload explicitly
+    messages = relationship(
+        "Message",
+        back_populates="user",
+        cascade="all, delete-orphan",
+        lazy="raise",
+        order_by="Message.id"
+    )
+    summarizations = relationship(
+        "Summarization",
+        back_populates="user",
+        cascade="all, delete-orphan",
+        lazy="raise",
+        order_by="Summarization.id"
+    )
+    answers = relationship(
+        "OnboardingAnswer",
+        back_populates="user",
+        cascade="all, delete-orphan",
+        lazy="raise",
+        order_by="OnboardingAnswer.step"
+    )
 
     def has_all_curators_selected(self) -> bool:
         """Check if user has selected all required curators."""
@@ -71,13 +107,8 @@ class User(Base):
 
     def get_curator_for_sphere(self, sphere: str) -> str:
         """Get selected curator for a given sphere."""
-        mapping = {
-            "business": self.selected_business,
-            "soul": self.selected_soul,
-            "body": self.selected_body,
-            "center": self.selected_center
-        }
-        return mapping.get(sphere)
+        getter = _CURATOR_GETTERS.get(sphere)
+        return getter(self) if getter else None
 
     def __repr__(self):
         return f"<User(id={self.id}, telegram_id={self.telegram_id}, username={self.username})>"
@@ -85,16 +116,20 @@ class User(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_user_sphere_created", "user_id", "sphere", "created_at"),
+        Index("ix_messages_user_sphere_role", "user_id", "sphere", "role"),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     sphere = Column(String(20), nullable=False)  # center, soul, body, business
     role = Column(String(20), nullable=False)  # user or assistant
     content = Column(Text, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=UTC_NOW_SQL, server_default=UTC_NOW_DDL)
     
     # Relationship
-    user = relationship("User", back_populates="messages")
+    user = relationship("User", back_populates="messages", lazy="raise")
 
     def __repr__(self):
         return f"<Message(id={self.id}, sphere={self.sphere}, role={self.role})>"
@@ -102,17 +137,55 @@ class Message(Base):
 
 class Summarization(Base):
     __tablename__ = "summarizations"
+    __table_args__ = (
+        Index("ix_summ_user_sphere_created", "user_id", "sphere", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     sphere = Column(String(20), nullable=False)  # soul, body, business
     text = Column(Text, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=UTC_NOW_SQL, server_default=UTC_NOW_DDL)
     
     # Relationship
-    user = relationship("User", back_populates="summarizations")
+    user = relationship("User", back_populates="summarizations", lazy="raise")
 
     def __repr__(self):
         return f"<Summarization(id={self.id}, sphere={self.sphere})>"
 
 
+
+
+class OnboardingAnswer(Base):
+    """One answer of the onboarding test; a row per question instead of a JSON list."""
+    __tablename__ = "onboarding_answers"
+    __table_args__ = (
+        Index("ix_onboarding_answers_user_step", "user_id", "step", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    step = Column(Integer, nullable=False)
+    question_key = Column(String(100), nullable=False)
+    question = Column(Text, nullable=False)
+    answer = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=UTC_NOW_SQL, server_default=UTC_NOW_DDL)
+    
+    # Relationship
+    user = relationship("User", back_populates="answers", lazy="raise")
+
+    def __repr__(self):
+        return f"<OnboardingAnswer(id={self.id}, user_id={self.user_id}, step={self.step})>"
+
+
+class Transcript(Base):
+    """Whisper transcript of a voice message, keyed by the SHA-256 of its audio."""
+    __tablename__ = "transcripts"
+
+    id = Column(Integer, primary_key=True)
+    audio_hash = Column(String(64), nullable=False, unique=True)
+    text = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=UTC_NOW_SQL, server_default=UTC_NOW_DDL)
+
+    def __repr__(self):
+        return f"<Transcript(id={self.id}, audio_hash={self.audio_hash[:12]})>"
@@ -1,6 +1,7 @@
+import os
 import logging
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
 from contextlib import contextmanager
 
 from .models import Base
@@ -9,17 +10,86 @@ logger = logging.getLogger(__name__)
 
 DATABASE_URL = "sqlite:///bot_database.db"
 
-engine = create_engine(DATABASE_URL, echo=False)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    # Log pool checkouts and returns, to debug connection storms
+    echo_pool="debug" if os.getenv("SQLALCHEMY_ECHO_POOL") == "1" else False,
+    # Sized for the bot's concurrent handlers plus Flask worker threads; WAL lets readers share the file
+    pool_size=20,
+    max_overflow=40,
+    pool_timeout=10,
+    pool_recycle=1800,
+    pool_pre_ping=True,
+    connect_args={"check_same_thread": False}
+)
+# One session per thread; get_session() removes it again when the block ends.
+# Blocks must not await or nest, since coroutines share the event loop thread.
+SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+
+# Same pool, but without BEGIN/COMMIT around each statement; for pure SELECTs only
+read_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+ReadSessionLocal = sessionmaker(bind=read_engine, autoflush=False, expire_on_commit=False)
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tune every new SQLite connection for concurrent reads and cheap commits."""
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers proceed while a writer commits; NORMAL sync is safe under WAL
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.close()
 
 
 def init_db():
     """Initialize database and create all tables."""
     logger.info("Initializing database...")
     Base.metadata.create_all(bind=engine)
+    
+    # create_all skips indexes of tables that already exist
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    
+    _migrate_onboarding_answers()
+    
+    with engine.connect() as connection:
+        connection.execute(text("ANALYZE"))
+    
     logger.info("Database initialized successfully")
 
 
+def _migrate_onboarding_answers():
+    """Move answers still stored in the legacy users.onboarding_answers JSON into their own table."""
+    with engine.begin() as connection:
+        result = connection.execute(text("""
+            INSERT OR IGNORE INTO onboarding_answers (user_id, step, question_key, question, answer)
+            SELECT u.id,
+                   CAST(j.key AS INTEGER),
+                   COALESCE(json_extract(j.value, '$.question_key'), 'question_' || j.key),
+                   COALESCE(json_extract(j.value, '$.question'), ''),
+                   COALESCE(json_extract(j.value, '$.answer'), '')
+            FROM users AS u, json_each(u.onboarding_answers) AS j
+            WHERE u.onboarding_answers NOT IN ('', '[]') AND json_valid(u.onboarding_answers)
+        """))
+        if result.rowcount:
+            logger.info(f"Migrated {result.rowcount} legacy onboarding answers")
+        connection.execute(text(
+            "UPDATE users SET onboarding_answers = '' WHERE onboarding_answers NOT IN ('', '[]')"
+        ))
+
+
+def optimize_db():
+    """Let SQLite refresh planner statistics for tables that need it."""
+    logger.debug("Running PRAGMA optimize")
+    with engine.connect() as connection:
+        connection.execute(text("PRAGMA optimize"))
+
+
 @contextmanager
 def get_session() -> Session:
     """Get database session context manager."""
@@ -32,6 +102,14 @@ def get_session() -> Session:
         logger.error(f"Database session error: {e}")
         raise
     finally:
-        session.close()
+        SessionLocal.remove()
 
 
+@contextmanager
+def get_read_session() -> Session:
+    """Get a read-only session context manager that runs outside a transaction."""
+    session = ReadSessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
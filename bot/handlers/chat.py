@@ -1,21 +1,33 @@
+import asyncio
 import logging
+from dataclasses import dataclass
 from typing import Optional
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from ..database import get_session, User, Message
+from ..database import get_session, get_read_session, Message
 from ..services import AIService, SummarizationService
 from ..utils import (
-    get_or_create_user,
     build_sphere_prompt,
     detect_sphere_from_topic,
     get_sphere_by_thread,
-    update_user_thread
+    update_user_thread,
+    get_user_snapshot,
+    spawn_background,
+    UserSnapshot
 )
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass(slots=True)
+class MessageContext:
+    """Who is writing, in which sphere, and to which curator."""
+    user: UserSnapshot
+    sphere: str
+    curator: str
+
+
 class ChatHandler:
     """Handler for chat messages with AI agents."""
     
@@ -24,58 +36,73 @@ class ChatHandler:
         self.summarization_service = summarization_service
         logger.info("ChatHandler initialized")
     
-    def _user_has_all_curators(self, telegram_id: int) -> bool:
+    def _user_has_all_curators(self, user: Optional[UserSnapshot]) -> bool:
         """Check if user has selected all curators."""
-        with get_session() as session:
-            user = session.query(User).filter(User.telegram_id == telegram_id).first()
-            if not user:
-                return False
-            return all([
-                user.selected_center,
-                user.selected_business,
-                user.selected_soul,
-                user.selected_body
-            ])
+        return bool(user and user.has_all_curators_selected())
     
-    def _get_user_curator(self, telegram_id: int, sphere: str) -> Optional[str]:
+    def _get_user_curator(self, user: UserSnapshot, sphere: str) -> Optional[str]:
         """Get the curator selected for a specific sphere."""
+        return user.get_curator_for_sphere(sphere)
+    
+    def _store_messages(self, user_id: int, sphere: str, user_text: str, ai_response: str):
+        """Store a user message and the assistant reply with a single INSERT."""
         with get_session() as session:
-            user = session.query(User).filter(User.telegram_id == telegram_id).first()
-            if not user:
-                return None
-            
-            if sphere == "center":
-                return user.selected_center
-            elif sphere == "business":
-                return user.selected_business
-            elif sphere == "soul":
-                return user.selected_soul
-            elif sphere == "body":
-                return user.selected_body
-            
-            return None
+            session.bulk_insert_mappings(Message, [
+                {"user_id": user_id, "sphere": sphere, "role": "user", "content": user_text},
+                {"user_id": user_id, "sphere": sphere, "role": "assistant", "content": ai_response}
+            ])
     
-    async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle incoming text messages."""
+    def _build_prompt(self, ctx: MessageContext) -> str:
+        """Build the system prompt for the resolved sphere and curator."""
+        with get_read_session() as session:
+            return build_sphere_prompt(session, ctx.user.id, ctx.sphere, ctx.curator)
+    
+    async def _persist_and_summarize(self, user_id: int, sphere: str, user_text: str, ai_response: str):
+        """Store the exchange and run summarization after the reply was sent."""
+        await asyncio.to_thread(self._store_messages, user_id, sphere, user_text, ai_response)
+        logger.info("Stored messages for user %s in sphere %s", user_id, sphere)
+        self.summarization_service.note_messages(user_id, sphere, user_text, ai_response)
+        
+        try:
+            await self.summarization_service.summarize(user_id, sphere)
+        except Exception as e:
+            # Summarization failures must not lose the stored messages
+            logger.error("Error during summarization: %s", e, exc_info=True)
+    
+    async def _resolve_context(
+        self,
+        update: Update,
+        user: Optional[UserSnapshot] = None
+    ) -> Optional[MessageContext]:
+        """
+        Resolve the user, sphere and curator for an incoming message.
+        
+        Sends the matching error reply and returns None when the message
+        cannot be answered.
+        
+        Args:
+            update: The incoming update
+            user: Snapshot the caller already loaded, if any
+            
+        Returns:
+            The resolved message context, or None
+        """
         telegram_id = update.effective_user.id
-        username = update.effective_user.username
-        first_name = update.effective_user.first_name
-        last_name = update.effective_user.last_name
-        message_text = update.message.text
         chat_id = update.effective_chat.id
         message_thread_id = update.message.message_thread_id
         
-        logger.info(f"Received text message from user {telegram_id}: {message_text[:50]}...")
-        logger.info(f"Chat ID: {chat_id}, Thread ID: {message_thread_id}")
+        # The voice path hands over the snapshot it already loaded
+        if user is None:
+            user = await asyncio.to_thread(get_user_snapshot, telegram_id)
         
         # Check if user has all curators selected
-        if not self._user_has_all_curators(telegram_id):
-            logger.warning(f"User {telegram_id} hasn't selected all curators yet")
+        if not self._user_has_all_curators(user):
+            logger.warning("User %s hasn't selected all curators yet", telegram_id)
             await update.message.reply_text(
                 "Пожалуйста, сначала выберите наставников для всех сфер. "
                 "Используйте команду /curators"
             )
-            return
+            return None
         
         # Detect sphere from topic name
         sphere = None
@@ -87,12 +114,20 @@ class ChatHandler:
                 topic_name = update.message.reply_to_message.forum_topic_created.name
                 sphere = detect_sphere_from_topic(topic_name)
                 if sphere:
-                    # Update user's thread mapping
-                    update_user_thread(telegram_id, sphere, message_thread_id, chat_id)
+                    stored = await asyncio.to_thread(
+                        get_sphere_by_thread, telegram_id, chat_id, message_thread_id
+                    )
+                    if stored != sphere:
+                        # Update user's thread mapping only when it changed
+                        await asyncio.to_thread(
+                            update_user_thread, telegram_id, sphere, message_thread_id, chat_id
+                        )
             
             # If not found from topic creation, try to get from stored mapping
             if not sphere:
-                sphere = get_sphere_by_thread(telegram_id, chat_id, message_thread_id)
+                sphere = await asyncio.to_thread(
+                    get_sphere_by_thread, telegram_id, chat_id, message_thread_id
+                )
         
         # If no sphere detected and it's a direct message (not in topic)
         if not sphere and not message_thread_id:
@@ -101,77 +136,67 @@ class ChatHandler:
             logger.info("No thread ID, defaulting to center sphere")
         
         if not sphere:
-            logger.warning(f"Could not detect sphere for message from user {telegram_id}")
+            logger.warning("Could not detect sphere for message from user %s", telegram_id)
             await update.message.reply_text(
                 "Не удалось определить сферу для этого сообщения. "
                 "Пожалуйста, убедитесь, что пишете в правильном топике."
             )
-            return
+            return None
         
-        logger.info(f"Detected sphere: {sphere}")
+        logger.info("Detected sphere: %s", sphere)
         
         # Get curator for the sphere
-        curator = self._get_user_curator(telegram_id, sphere)
+        curator = self._get_user_curator(user, sphere)
         if not curator:
-            logger.error(f"No curator found for sphere {sphere}")
+            logger.error("No curator found for sphere %s", sphere)
             await update.message.reply_text("Ошибка: не найден куратор для этой сферы.")
-            return
+            return None
+        
+        logger.info("Using curator: %s for sphere: %s", curator, sphere)
+        
+        return MessageContext(user=user, sphere=sphere, curator=curator)
+    
+    async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle incoming text messages."""
+        telegram_id = update.effective_user.id
+        message_text = update.message.text
+        chat_id = update.effective_chat.id
+        message_thread_id = update.message.message_thread_id
         
-        logger.info(f"Using curator: {curator} for sphere: {sphere}")
+        logger.info("Received text message from user %s: %s...", telegram_id, message_text[:50])
+        logger.info("Chat ID: %s, Thread ID: %s", chat_id, message_thread_id)
+        
+        ctx = await self._resolve_context(update)
+        if ctx is None:
+            return
         
         # Send typing action
         await context.bot.send_chat_action(chat_id=chat_id, action="typing")
         
         try:
-            # Get user from database
-            user = get_or_create_user(telegram_id, username, first_name, last_name)
-            
             # Build the prompt
-            system_prompt = build_sphere_prompt(user.id, sphere, curator)
+            system_prompt = await asyncio.to_thread(self._build_prompt, ctx)
             
             # Generate AI response
-            logger.info(f"Generating AI response for user {telegram_id} in sphere {sphere}")
+            logger.info("Generating AI response for user %s in sphere %s", telegram_id, ctx.sphere)
             ai_response = await self.ai_service.generate_response(
                 prompt=message_text,
                 system_instruction=system_prompt
             )
             
-            # Store both messages in database
-            with get_session() as session:
-                # Store user message
-                user_msg = Message(
-                    user_id=user.id,
-                    sphere=sphere,
-                    role="user",
-                    content=message_text
-                )
-                session.add(user_msg)
-                
-                # Store assistant message
-                assistant_msg = Message(
-                    user_id=user.id,
-                    sphere=sphere,
-                    role="assistant",
-                    content=ai_response
-                )
-                session.add(assistant_msg)
-            
-            logger.info(f"Stored messages for user {telegram_id} in sphere {sphere}")
-            
             # Send the response
             await update.message.reply_text(ai_response)
             
-            logger.info(f"Sent AI response to user {telegram_id}")
+            logger.info("Sent AI response to user %s", telegram_id)
             
-            # Check if summarization is needed
-            try:
-                await self.summarization_service.summarize(user.id, sphere)
-            except Exception as e:
-                logger.error(f"Error during summarization: {e}", exc_info=True)
-                # Don't fail the whole request if summarization fails
+            # Store messages and check summarization off the reply path
+            spawn_background(
+                self._persist_and_summarize(ctx.user.id, ctx.sphere, message_text, ai_response),
+                name=f"persist-{telegram_id}"
+            )
             
         except Exception as e:
-            logger.error(f"Error handling text message: {e}", exc_info=True)
+            logger.error("Error handling text message: %s", e, exc_info=True)
             await update.message.reply_text(
                 f"Произошла ошибка при обработке сообщения: {str(e)}"
             )
@@ -180,113 +205,44 @@ class ChatHandler:
         self,
         update: Update,
         context: ContextTypes.DEFAULT_TYPE,
-        text: str
+        text: str,
+        user: Optional[UserSnapshot] = None
     ):
         """Process transcribed text from voice message."""
         # Create a modified update with the transcribed text
         # Then handle it like a regular text message
         
         telegram_id = update.effective_user.id
-        username = update.effective_user.username
         chat_id = update.effective_chat.id
-        message_thread_id = update.message.message_thread_id if update.message else None
-        
-        logger.info(f"Processing transcribed text for user {telegram_id}: {text[:50]}...")
-        
-        # Check if user has all curators selected
-        if not self._user_has_all_curators(telegram_id):
-            logger.warning(f"User {telegram_id} hasn't selected all curators yet")
-            await update.message.reply_text(
-                "Пожалуйста, сначала выберите наставников для всех сфер. "
-                "Используйте команду /curators"
-            )
-            return
-        
-        # Detect sphere from topic name
-        sphere = None
-        
-        # Try to get sphere from message thread topic
-        if message_thread_id:
-            # Try to get topic name from the message
-            if update.message.reply_to_message and update.message.reply_to_message.forum_topic_created:
-                topic_name = update.message.reply_to_message.forum_topic_created.name
-                sphere = detect_sphere_from_topic(topic_name)
-                if sphere:
-                    # Update user's thread mapping
-                    update_user_thread(telegram_id, sphere, message_thread_id, chat_id)
-            
-            # If not found from topic creation, try to get from stored mapping
-            if not sphere:
-                sphere = get_sphere_by_thread(telegram_id, chat_id, message_thread_id)
-        
-        # If no sphere detected and it's a direct message (not in topic)
-        if not sphere and not message_thread_id:
-            sphere = "center"
-            logger.info("No thread ID, defaulting to center sphere")
-        
-        if not sphere:
-            logger.warning(f"Could not detect sphere for voice message from user {telegram_id}")
-            await update.message.reply_text(
-                "Не удалось определить сферу для этого сообщения. "
-                "Пожалуйста, убедитесь, что пишете в правильном топике."
-            )
-            return
         
-        logger.info(f"Detected sphere: {sphere}")
+        logger.info("Processing transcribed text for user %s: %s...", telegram_id, text[:50])
         
-        # Get curator
-        curator = self._get_user_curator(telegram_id, sphere)
-        if not curator:
-            await update.message.reply_text("Ошибка: не найден куратор для этой сферы.")
+        ctx = await self._resolve_context(update, user)
+        if ctx is None:
             return
         
         # Send typing action
         await context.bot.send_chat_action(chat_id=chat_id, action="typing")
         
         try:
-            user = get_or_create_user(
-                telegram_id, 
-                update.effective_user.username,
-                update.effective_user.first_name,
-                update.effective_user.last_name
-            )
-            
             # Build prompt and generate response
-            system_prompt = build_sphere_prompt(user.id, sphere, curator)
+            system_prompt = await asyncio.to_thread(self._build_prompt, ctx)
             ai_response = await self.ai_service.generate_response(
                 prompt=text,
                 system_instruction=system_prompt
             )
             
-            # Store messages
-            with get_session() as session:
-                user_msg = Message(
-                    user_id=user.id,
-                    sphere=sphere,
-                    role="user",
-                    content=text
-                )
-                session.add(user_msg)
-                
-                assistant_msg = Message(
-                    user_id=user.id,
-                    sphere=sphere,
-                    role="assistant",
-                    content=ai_response
-                )
-                session.add(assistant_msg)
-            
             # Send response
             await update.message.reply_text(ai_response)
             
-            # Check summarization
-            try:
-                await self.summarization_service.summarize(user.id, sphere)
-            except Exception as e:
-                logger.error(f"Error during summarization: {e}", exc_info=True)
+            # Store messages and check summarization off the reply path
+            spawn_background(
+                self._persist_and_summarize(ctx.user.id, ctx.sphere, text, ai_response),
+                name=f"persist-{telegram_id}"
+            )
             
         except Exception as e:
-            logger.error(f"Error processing transcribed text: {e}", exc_info=True)
+            logger.error("Error processing transcribed text: %s", e, exc_info=True)
             await update.message.reply_text(
                 f"Произошла ошибка при обработке сообщения: {str(e)}"
             )
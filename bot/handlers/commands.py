@@ -1,17 +1,98 @@
-import os
 import json
+import asyncio
 import logging
 from datetime import datetime
+from functools import lru_cache
+from io import BytesIO
 from pathlib import Path
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from typing import Tuple, Union
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import ContextTypes
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader, Template, TemplateError
 
-from ..database import get_session, User
-from ..utils import get_or_create_user, get_all_spheres_history, get_help_text
+from ..database import User
+from ..utils import (
+    get_or_create_user,
+    get_all_spheres_history,
+    get_help_text,
+    get_user_snapshot,
+    get_curator_page_url,
+    build_curators_keyboard,
+    UserSnapshot,
+    CURATORS_MESSAGE_TEXT
+)
 
 logger = logging.getLogger(__name__)
 
+POSTER_HANDLES = ("cryptohype", "neonoir")
+POSTERS_CONTENT_DIR = Path(__file__).parent.parent.parent / "content" / "posters"
+GENERATED_POSTERS_DIR = Path(__file__).parent.parent.parent / "generated" / "posters"
+
+# Static replies, built once
+START_WELCOME_TEXT = (
+    "Добро пожаловать! 👋\n\n"
+    "Давайте начнём с небольшого теста, чтобы понять вас лучше и подобрать подходящих наставников."
+)
+START_RETURNING_TEXT = (
+    "С возвращением! 👋\n\n"
+    "Вы уже прошли тест. Используйте /curators для выбора наставников "
+    "или /reset_goals для повторного прохождения теста."
+)
+RESET_GOALS_TEXT = (
+    "Начинаем тест заново! 🔄\n\n"
+    "Отвечайте на вопросы, отправляя текстовые сообщения."
+)
+CURATORS_NO_USER_TEXT = "Пожалуйста, сначала пройдите тест с помощью команды /start"
+CURATORS_ONBOARDING_TEXT = "Пожалуйста, сначала завершите тест личности."
+POSTER_MENU_TEXT = (
+    "Выбери свой постер:\n"
+    "- \"Криптохайп\"\n"
+    "- \"Неонуар\""
+)
+# Telegram objects are immutable, so one keyboard instance serves every /poster
+POSTER_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Криптохайп", callback_data="poster_cryptohype")],
+    [InlineKeyboardButton("Неонуар", callback_data="poster_neonoir")]
+])
+
+# Shared by all poster handles; templates never change while the bot runs
+_poster_env = Environment(
+    loader=FileSystemLoader(str(POSTERS_CONTENT_DIR)),
+    auto_reload=False,
+    cache_size=400
+)
+
+
+@lru_cache(maxsize=None)
+def _load_poster_templates(handle: str) -> Tuple[Template, Template, Template]:
+    """
+    Compile the templates used to generate a poster.
+    
+    Args:
+        handle: Poster handle (cryptohype or neonoir)
+        
+    Returns:
+        Tuple of (variables, imagePrompt, imageBasePrompt) templates
+    """
+    variables_path = POSTERS_CONTENT_DIR / handle / "variables.txt"
+    if not variables_path.exists():
+        raise FileNotFoundError(f"Variables file not found: {variables_path}")
+    
+    image_prompt_path = POSTERS_CONTENT_DIR / handle / "imagePrompt.json"
+    if not image_prompt_path.exists():
+        raise FileNotFoundError(f"Image prompt file not found: {image_prompt_path}")
+    
+    image_base_prompt_path = POSTERS_CONTENT_DIR / "imageBasePrompt.txt"
+    if not image_base_prompt_path.exists():
+        raise FileNotFoundError(f"Image base prompt file not found: {image_base_prompt_path}")
+    
+    logger.debug(f"Compiling poster templates for '{handle}'")
+    return (
+        _poster_env.get_template(f"{handle}/variables.txt"),
+        _poster_env.get_template(f"{handle}/imagePrompt.json"),
+        _poster_env.get_template("imageBasePrompt.txt")
+    )
+
 
 class CommandsHandler:
     """Handler for bot commands."""
@@ -19,6 +100,14 @@ class CommandsHandler:
     def __init__(self, onboarding_handler, ai_service=None):
         self.onboarding_handler = onboarding_handler
         self.ai_service = ai_service
+        
+        # Compile poster templates up front so /poster never pays for it
+        for handle in POSTER_HANDLES:
+            try:
+                _load_poster_templates(handle)
+            except (FileNotFoundError, TemplateError) as e:
+                logger.warning(f"Could not precompile poster templates for '{handle}': {e}")
+        
         logger.info("CommandsHandler initialized")
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -36,18 +125,11 @@ class CommandsHandler:
         # Check if user needs onboarding
         if user.is_onboarding:
             logger.info(f"User {telegram_id} needs onboarding")
-            await update.message.reply_text(
-                "Добро пожаловать! 👋\n\n"
-                "Давайте начнём с небольшого теста, чтобы понять вас лучше и подобрать подходящих наставников."
-            )
+            await update.message.reply_text(START_WELCOME_TEXT)
             await self.onboarding_handler.start_onboarding(update, context)
         else:
             logger.info(f"User {telegram_id} already completed onboarding")
-            await update.message.reply_text(
-                "С возвращением! 👋\n\n"
-                "Вы уже прошли тест. Используйте /curators для выбора наставников "
-                "или /reset_goals для повторного прохождения теста."
-            )
+            await update.message.reply_text(START_RETURNING_TEXT)
     
     async def reset_goals_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /reset_goals command - restart the goals test."""
@@ -55,10 +137,7 @@ class CommandsHandler:
         
         logger.info(f"Reset goals command from user {telegram_id}")
         
-        await update.message.reply_text(
-            "Начинаем тест заново! 🔄\n\n"
-            "Отвечайте на вопросы, отправляя текстовые сообщения."
-        )
+        await update.message.reply_text(RESET_GOALS_TEXT)
         
         await self.onboarding_handler.start_onboarding(update, context)
     
@@ -69,46 +148,26 @@ class CommandsHandler:
         logger.info(f"Curators command from user {telegram_id}")
         
         # Check if user has completed onboarding
-        with get_session() as session:
-            user = session.query(User).filter(User.telegram_id == telegram_id).first()
-            
-            if not user:
-                logger.warning(f"User {telegram_id} not found")
-                await update.message.reply_text(
-                    "Пожалуйста, сначала пройдите тест с помощью команды /start"
-                )
-                return
-            
-            if user.is_onboarding:
-                logger.warning(f"User {telegram_id} is still in onboarding")
-                await update.message.reply_text(
-                    "Пожалуйста, сначала завершите тест личности."
-                )
-                return
+        is_onboarding = await self.onboarding_handler.get_onboarding_state(telegram_id)
         
-        # Show curators selection message
-        webapp_url = os.getenv("WEBAPP_URL", "http://127.0.0.1:5000")
-        curator_page_url = f"{webapp_url}/curator-choice?user_id={telegram_id}"
+        if is_onboarding is None:
+            logger.warning(f"User {telegram_id} not found")
+            await update.message.reply_text(CURATORS_NO_USER_TEXT)
+            return
         
-        message_text = (
-            "Сейчас тебе нужно выбрать наставников! "
-            "Не волнуйся, ты всегда сможешь изменить свой выбор и выбрать того, кто тебе больше по душе."
-        )
+        if is_onboarding:
+            logger.warning(f"User {telegram_id} is still in onboarding")
+            await update.message.reply_text(CURATORS_ONBOARDING_TEXT)
+            return
         
-        logger.info(f"Sending curators message with webapp URL: {curator_page_url}")
+        # Show curators selection message
+        curator_page_url = get_curator_page_url(telegram_id)
         
-        # Check if URL is HTTPS (required for web_app buttons)
-        # If not HTTPS, use regular URL button instead
-        keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton(
-                    "Выбрать наставников",
-                    url=curator_page_url
-                )]
-            ])
+        logger.info(f"Sending curators message with webapp URL: {curator_page_url}")
         
         await update.message.reply_text(
-            text=message_text,
-            reply_markup=keyboard
+            text=CURATORS_MESSAGE_TEXT,
+            reply_markup=build_curators_keyboard(curator_page_url)
         )
     
     async def poster_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -117,22 +176,11 @@ class CommandsHandler:
         
         logger.info(f"Poster command from user {telegram_id}")
         
-        message_text = (
-            "Выбери свой постер:\n"
-            "- \"Криптохайп\"\n"
-            "- \"Неонуар\""
-        )
-        
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Криптохайп", callback_data="poster_cryptohype")],
-            [InlineKeyboardButton("Неонуар", callback_data="poster_neonoir")]
-        ])
-        
         chat_id = update.effective_chat.id
         await context.bot.send_message(
             chat_id=chat_id,
-            text=message_text,
-            reply_markup=keyboard
+            text=POSTER_MENU_TEXT,
+            reply_markup=POSTER_KEYBOARD
         )
     
     async def handle_poster_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -166,23 +214,26 @@ class CommandsHandler:
                 text="Генерирую изображение. Это займет до 2х минут"
             )
             
-            # Get user
-            user = get_or_create_user(
-                telegram_id, 
-                update.effective_user.username,
-                update.effective_user.first_name,
-                update.effective_user.last_name
-            )
+            # Get user, refreshing the stored profile only when the stored name is stale;
+            # both are database calls, so keep them off the event loop
+            user = await asyncio.to_thread(get_user_snapshot, telegram_id)
+            if user is None or user.first_name != update.effective_user.first_name:
+                user = await asyncio.to_thread(
+                    get_or_create_user,
+                    telegram_id,
+                    update.effective_user.username,
+                    update.effective_user.first_name,
+                    update.effective_user.last_name
+                )
             
             # Generate poster
-            image_path = await self._generate_poster(user, handle)
+            image_path, image_bytes = await self._generate_poster(user, handle)
             
-            # Send image to user
-            with open(image_path, 'rb') as photo:
-                await context.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=photo
-                )
+            # Send image to user straight from memory, named after the saved file
+            await context.bot.send_photo(
+                chat_id=chat_id,
+                photo=InputFile(BytesIO(image_bytes), filename=image_path.name)
+            )
             
             logger.info(f"Successfully generated and sent poster '{handle}' for user {telegram_id}")
             
@@ -193,16 +244,16 @@ class CommandsHandler:
                 text=f"Произошла ошибка при генерации постера: {str(e)}"
             )
     
-    async def _generate_poster(self, user: User, handle: str) -> str:
+    async def _generate_poster(self, user: Union[User, UserSnapshot], handle: str) -> Tuple[Path, bytes]:
         """
         Generate a poster for a user.
         
         Args:
-            user: user
+            user: user or its cached snapshot (only id and first_name are used)
             handle: Poster handle (cryptohype or neonoir)
             
         Returns:
-            Path to the generated image file
+            Tuple of (path of the saved image file, image bytes)
         """
         user_id = user.id
         logger.info(f"Generating poster '{handle}' for user {user_id}")
@@ -210,58 +261,33 @@ class CommandsHandler:
         if not self.ai_service:
             raise ValueError("AI service not available")
         
-        # Get content directory
-        content_dir = Path(__file__).parent.parent.parent / "content" / "posters"
-        generated_dir = Path(__file__).parent.parent.parent / "generated" / "posters"
+        generated_dir = GENERATED_POSTERS_DIR
         
         # Create generated directory if it doesn't exist
         generated_dir.mkdir(parents=True, exist_ok=True)
         
-        # Read variables.txt
-        variables_path = content_dir / handle / "variables.txt"
-        if not variables_path.exists():
-            raise FileNotFoundError(f"Variables file not found: {variables_path}")
-        
-        with open(variables_path, "r", encoding="utf-8") as f:
-            variables_template = f.read()
+        variables_template, image_prompt_template, base_template = _load_poster_templates(handle)
         
         # Get history from all spheres
         history = get_all_spheres_history(user_id)
         
         # Generate variables using AI (using nunjucks/jinja2 template)
-        template = Template(variables_template)
-        variables_prompt = template.render(history=history)
+        variables_prompt = variables_template.render(history=history)
 
         logger.info("Generating variables JSON from AI...")
         variables_json = await self.ai_service.generate_json_response(variables_prompt)
-        
-        # Read imagePrompt.json
-        image_prompt_path = content_dir / handle / "imagePrompt.json"
-        if not image_prompt_path.exists():
-            raise FileNotFoundError(f"Image prompt file not found: {image_prompt_path}")
-        
-        with open(image_prompt_path, "r", encoding="utf-8") as f:
-            image_prompt_template = f.read()
+        logger.debug("variables_json: %s", variables_json)
         
         # Render imagePrompt with variables
-        image_prompt_template_obj = Template(image_prompt_template)
 
         # if user.username:
         #     variables_json['username'] = '@' + user.name
         variables_json['first_name'] = user.first_name
 
-        image_prompt = image_prompt_template_obj.render(**variables_json)
-
-        # Read imageBasePrompt.txt
-        image_base_prompt_path = content_dir / "imageBasePrompt.txt"
-        if not image_base_prompt_path.exists():
-            raise FileNotFoundError(f"Image base prompt file not found: {image_base_prompt_path}")
-        
-        with open(image_base_prompt_path, "r", encoding="utf-8") as f:
-            image_base_prompt_template = f.read()
+        image_prompt = image_prompt_template.render(**variables_json)
+        logger.debug("image_prompt: %s", image_prompt)
         
         # Render imageBasePrompt with imagePrompt
-        base_template = Template(image_base_prompt_template)
         final_prompt = base_template.render(imagePrompt=image_prompt)
         
         logger.info("Generating image from Gemini...")
@@ -273,12 +299,12 @@ class CommandsHandler:
         image_filename = f"{handle}_{user_id}_{timestamp}.png"
         image_path = generated_dir / image_filename
         
-        with open(image_path, 'wb') as f:
-            f.write(image_bytes)
+        # Keep the event loop free while the file is written
+        await asyncio.to_thread(image_path.write_bytes, image_bytes)
         
         logger.info(f"Saved image to {image_path}")
         
-        return str(image_path)
+        return image_path, image_bytes
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command."""
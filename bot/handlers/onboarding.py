@@ -1,22 +1,56 @@
-import os
-import json
+import asyncio
 import logging
-from typing import Optional
+import weakref
+from typing import Optional, Tuple
+import sqlalchemy as sa
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from ..database import get_session, User, Message
-from ..utils import get_or_create_user, load_onboarding_questions, get_help_text, CONTENT_DIR
+from ..database import get_session, get_read_session, User, Message, OnboardingAnswer
+from ..utils import (
+    get_or_create_user,
+    load_onboarding_questions,
+    get_help_text,
+    spawn_background,
+    get_curator_page_url,
+    build_curators_keyboard,
+    CURATORS_MESSAGE_TEXT,
+    CONTENT_DIR
+)
+from ..utils.cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# telegram_id -> is_onboarding; every message is routed on this flag.
+# Only this handler changes it, and it updates the cache on every write.
+ONBOARDING_CACHE_TTL_SECONDS = 60
+
+_onboarding_state = TTLCache(ttl=ONBOARDING_CACHE_TTL_SECONDS)
+
+# One lock per user while their completion runs in the background
+_completion_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _completion_lock(telegram_id: int) -> asyncio.Lock:
+    """Get the lock that serializes onboarding completion for a user."""
+    lock = _completion_locks.get(telegram_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _completion_locks[telegram_id] = lock
+    return lock
+
 
 class OnboardingHandler:
     """Handler for user onboarding and goals test."""
     
     def __init__(self, ai_service=None):
         self.ai_service = ai_service
+        
         self.questions = load_onboarding_questions()
+        self._rendered_questions = [
+            self._build_question_message(question_data, step)
+            for step, question_data in enumerate(self.questions)
+        ]
         logger.info(f"OnboardingHandler initialized with {len(self.questions)} questions")
     
     async def start_onboarding(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -28,20 +62,43 @@ class OnboardingHandler:
         
         logger.info(f"Starting onboarding for user {telegram_id} ({username})")
         
+        # Database work runs in a worker thread so the event loop keeps serving updates
+        await asyncio.to_thread(self._reset_onboarding, telegram_id, username, first_name, last_name)
+        logger.info(f"Onboarding state reset for user {telegram_id}")
+        
+        # Send first question
+        await self._send_question(update, context, 0)
+    
+    def _reset_onboarding(
+        self,
+        telegram_id: int,
+        username: Optional[str],
+        first_name: Optional[str],
+        last_name: Optional[str]
+    ):
+        """Create the user if needed and reset their onboarding progress."""
         # Get or create user
-        user = get_or_create_user(telegram_id, username, first_name, last_name)
+        get_or_create_user(telegram_id, username, first_name, last_name)
         
         # Reset onboarding state
         with get_session() as session:
-            db_user = session.query(User).filter(User.telegram_id == telegram_id).first()
-            db_user.is_onboarding = True
-            db_user.onboarding_step = 0
-            db_user.onboarding_answers = "[]"
+            user_id = session.execute(
+                sa.update(User)
+                .where(User.telegram_id == telegram_id)
+                .values(is_onboarding=True, onboarding_step=0)
+                .returning(User.id)
+                .execution_options(synchronize_session=False)
+            ).scalar_one()
+            session.query(OnboardingAnswer).filter(
+                OnboardingAnswer.user_id == user_id
+            ).delete(synchronize_session=False)
         
-        logger.info(f"Onboarding state reset for user {telegram_id}")
-        
-        # Send first question
-        await self._send_question(update, context, 0)
+        _onboarding_state.set(telegram_id, True)
+    
+    def _build_question_message(self, question_data: dict, step: int) -> str:
+        """Render the message text for a question."""
+        prefix = f"[{step + 1}/{len(self.questions)}]"
+        return f"{prefix}\n\n{question_data['question']}\n\n_Отправьте ваш ответ текстовым сообщением._"
     
     async def _send_question(self, update: Update, context: ContextTypes.DEFAULT_TYPE, step: int):
         """Send a specific question to the user."""
@@ -49,10 +106,8 @@ class OnboardingHandler:
             logger.warning(f"Invalid step {step}, max is {len(self.questions) - 1}")
             return
         
-        question_data = self.questions[step]
-        question_text = question_data["question"]
-        prefix = f"[{step + 1}/{len(self.questions)}]"
-        message_text = f"{prefix}\n\n{question_text}\n\n_Отправьте ваш ответ текстовым сообщением._"
+        # Pre-rendered in __init__, the questions never change at runtime
+        message_text = self._rendered_questions[step]
         
         logger.info(f"Sending question {step + 1}/{len(self.questions)}")
         
@@ -74,93 +129,106 @@ class OnboardingHandler:
         
         logger.info(f"User {telegram_id} answered with text: {answer_text[:50]}...")
         
-        # Get current user state
-        with get_session() as session:
-            user = session.query(User).filter(User.telegram_id == telegram_id).first()
-            
-            if not user:
-                logger.error(f"User not found: {telegram_id}")
-                await update.message.reply_text("Ошибка: пользователь не найден. Пожалуйста, начните с /start")
-                return
-            
-            if not user.is_onboarding:
-                logger.warning(f"User {telegram_id} is not in onboarding mode")
-                await update.message.reply_text("Вы уже прошли тест. Используйте /reset_goals для повторного прохождения.")
-                return
-            
-            current_step = user.onboarding_step
-            
-            if current_step >= len(self.questions):
-                logger.warning(f"User {telegram_id} answered after completing test")
-                await update.message.reply_text("Тест уже завершен. Используйте /reset_goals для повторного прохождения.")
-                return
-            
-            # Store answer
-            answers = json.loads(user.onboarding_answers) if user.onboarding_answers else []
-            question_data = self.questions[current_step]
-            answers.append({
-                "question_key": question_data.get("key", f"question_{current_step}"),
-                "question": question_data["question"],
-                "answer": answer_text
-            })
-            user.onboarding_answers = json.dumps(answers, ensure_ascii=False)
-            
-            # Move to next step
-            user.onboarding_step = current_step + 1
-            next_step = user.onboarding_step
+        row, error_text = await asyncio.to_thread(self._store_answer, telegram_id, answer_text)
+        if error_text:
+            await update.message.reply_text(error_text)
+            return
         
+        user_id, next_step = row
         logger.info(f"User {telegram_id} moved to step {next_step}")
         
         # Check if test is complete
         if next_step >= len(self.questions):
-            await self._complete_onboarding(update, context, telegram_id)
+            # Finish in the background so the update handler returns right away
+            spawn_background(
+                self._finalize_onboarding_bg(update, context, telegram_id, user_id),
+                name=f"onboarding-{telegram_id}"
+            )
         else:
             await self._send_question(update, context, next_step)
     
-    async def _complete_onboarding(self, update: Update, context: ContextTypes.DEFAULT_TYPE, telegram_id: int):
-        """Complete the onboarding process and save results."""
+    def _store_answer(self, telegram_id: int, answer_text: str) -> Tuple[Optional[Tuple[int, int]], Optional[str]]:
+        """
+        Store an answer for the user's current step and advance to the next one.
+        
+        Args:
+            telegram_id: The user's Telegram ID
+            answer_text: The answer to store
+            
+        Returns:
+            Tuple of ((user_id, next_step), None) on success, or (None, error reply text)
+        """
+        # Advance the step with a single UPDATE ... RETURNING, then insert the answer row
+        with get_session() as session:
+            row = session.execute(
+                sa.update(User)
+                .where(
+                    User.telegram_id == telegram_id,
+                    User.is_onboarding.is_(True),
+                    User.onboarding_step < len(self.questions)
+                )
+                .values(onboarding_step=User.onboarding_step + 1)
+                .returning(User.id, User.onboarding_step)
+                .execution_options(synchronize_session=False)
+            ).first()
+            
+            if row is None:
+                # Nothing was updated; find out why (rare path)
+                state = session.query(User.is_onboarding).filter(User.telegram_id == telegram_id).first()
+            else:
+                current_step = row.onboarding_step - 1
+                question_data = self.questions[current_step]
+                session.add(OnboardingAnswer(
+                    user_id=row.id,
+                    step=current_step,
+                    question_key=question_data.get("key", f"question_{current_step}"),
+                    question=question_data["question"],
+                    answer=answer_text
+                ))
+        
+        if row is not None:
+            return (row.id, row.onboarding_step), None
+        
+        if state is None:
+            logger.error(f"User not found: {telegram_id}")
+            return None, "Ошибка: пользователь не найден. Пожалуйста, начните с /start"
+        if not state.is_onboarding:
+            logger.warning(f"User {telegram_id} is not in onboarding mode")
+            return None, "Вы уже прошли тест. Используйте /reset_goals для повторного прохождения."
+        logger.warning(f"User {telegram_id} answered after completing test")
+        return None, "Тест уже завершен. Используйте /reset_goals для повторного прохождения."
+    
+    async def _finalize_onboarding_bg(
+        self,
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        telegram_id: int,
+        user_id: int
+    ):
+        """Complete onboarding off the update handler, one completion per user at a time."""
+        async with _completion_lock(telegram_id):
+            await self._complete_onboarding(update, context, telegram_id, user_id)
+    
+    async def _complete_onboarding(
+        self,
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        telegram_id: int,
+        user_id: int
+    ):
+        """
+        Complete the onboarding process and save results.
+        
+        Args:
+            update: The incoming update
+            context: The callback context
+            telegram_id: The user's Telegram ID
+            user_id: The user's database ID
+        """
         logger.info(f"Completing onboarding for user {telegram_id}")
         
         try:
-            # Get user answers
-            with get_session() as session:
-                user = session.query(User).filter(User.telegram_id == telegram_id).first()
-                answers = json.loads(user.onboarding_answers) if user.onboarding_answers else []
-                
-                # Format all answers as a single text
-                formatted_answers = []
-                for answer_data in answers:
-                    formatted_answers.append(
-                        f"{answer_data['question']}\n{answer_data['answer']}"
-                    )
-                
-                results_text = "\n\n".join(formatted_answers)
-                
-                # Get existing first message in center sphere if exists
-                first_message = session.query(Message).filter(
-                    Message.user_id == user.id,
-                    Message.sphere == "center"
-                ).order_by(Message.id.asc()).first()
-                
-                if first_message:
-                    # Update the first message (overwrite previous test results)
-                    first_message.content = results_text
-                    first_message.role = "user"
-                    logger.info(f"Updated first message in center sphere for user {telegram_id} (overwriting previous test results)")
-                else:
-                    # Save results as the first message in center sphere
-                    center_message = Message(
-                        user_id=user.id,
-                        sphere="center",
-                        role="user",
-                        content=results_text
-                    )
-                    session.add(center_message)
-                    logger.info(f"Created first message in center sphere for user {telegram_id}")
-                
-                # Mark onboarding as complete
-                user.is_onboarding = False
-                session.commit()
+            await asyncio.to_thread(self._save_results, telegram_id, user_id)
             
             logger.info(f"Onboarding completed for user {telegram_id}, results saved to center sphere")
             
@@ -170,11 +238,11 @@ class OnboardingHandler:
                 "Ваши ответы сохранены. Теперь вы можете выбрать наставников."
             )
             
-            # Trigger the curators command flow
-            await self._show_curators_message(update, context)
-            
-            # Send help message
-            await self._send_help_message(update, context)
+            # The curators prompt and the help message don't depend on each other
+            await asyncio.gather(
+                self._show_curators_message(update, context),
+                self._send_help_message(update, context)
+            )
             
         except Exception as e:
             logger.error(f"Error completing onboarding: {e}", exc_info=True)
@@ -183,38 +251,65 @@ class OnboardingHandler:
                 "Пожалуйста, попробуйте снова с командой /reset_goals"
             )
     
+    def _save_results(self, telegram_id: int, user_id: int):
+        """Save the test results to the center sphere and mark onboarding as complete."""
+        with get_session() as session:
+            answers = session.query(OnboardingAnswer.question, OnboardingAnswer.answer).filter(
+                OnboardingAnswer.user_id == user_id
+            ).order_by(OnboardingAnswer.step).all()
+            
+            # Format all answers as a single text
+            results_text = "\n\n".join(f"{question}\n{answer}" for question, answer in answers)
+            
+            # Overwrite the first message in center sphere (previous test results), if any
+            first_message_id = sa.select(sa.func.min(Message.id)).where(
+                Message.user_id == user_id,
+                Message.sphere == "center"
+            ).scalar_subquery()
+            updated = session.execute(
+                sa.update(Message)
+                .where(Message.id == first_message_id)
+                .values(content=results_text, role="user")
+                .returning(Message.id)
+                .execution_options(synchronize_session=False)
+            ).first()
+            
+            if updated:
+                logger.info(f"Updated first message in center sphere for user {telegram_id} (overwriting previous test results)")
+            else:
+                # Save results as the first message in center sphere
+                center_message = Message(
+                    user_id=user_id,
+                    sphere="center",
+                    role="user",
+                    content=results_text
+                )
+                session.add(center_message)
+                logger.info(f"Created first message in center sphere for user {telegram_id}")
+            
+            # Mark onboarding as complete
+            session.execute(
+                sa.update(User)
+                .where(User.id == user_id)
+                .values(is_onboarding=False)
+                .execution_options(synchronize_session=False)
+            )
+        
+        _onboarding_state.set(telegram_id, False)
+    
     async def _show_curators_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show the curators selection message."""
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-        
-        webapp_url = os.getenv("WEBAPP_URL", "https://127.0.0.1:5000")
-        curator_page_url = f"{webapp_url}/curator-choice"
-        
-        message_text = (
-            "Сейчас тебе нужно выбрать наставников! "
-            "Не волнуйся, ты всегда сможешь изменить свой выбор и выбрать того, кто тебе больше по душе."
-        )
-        
         # Get user's telegram_id for the webapp
         telegram_id = update.effective_user.id
-        curator_page_url_with_user = f"{curator_page_url}?user_id={telegram_id}"
-
-        print(curator_page_url_with_user)
-        
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(
-                "Выбрать наставников",
-                url=curator_page_url_with_user
-            )]
-        ])
+        curator_page_url_with_user = get_curator_page_url(telegram_id)
         
         logger.info(f"Sending curators message with webapp URL: {curator_page_url_with_user}")
         
         chat_id = update.effective_chat.id
         await context.bot.send_message(
             chat_id=chat_id,
-            text=message_text,
-            reply_markup=keyboard
+            text=CURATORS_MESSAGE_TEXT,
+            reply_markup=build_curators_keyboard(curator_page_url_with_user)
         )
     
     async def _send_help_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -227,10 +322,28 @@ class OnboardingHandler:
             parse_mode="HTML"
         )
     
-    def is_user_onboarding(self, telegram_id: int) -> bool:
+    async def get_onboarding_state(self, telegram_id: int) -> Optional[bool]:
+        """Get the user's is_onboarding flag, or None if the user does not exist."""
+        state = _onboarding_state.get(telegram_id)
+        if state is not None:
+            return state
+        
+        return await asyncio.to_thread(self._load_onboarding_state, telegram_id)
+    
+    def _load_onboarding_state(self, telegram_id: int) -> Optional[bool]:
+        """Read the user's is_onboarding flag from the database and cache it."""
+        with get_read_session() as session:
+            row = session.query(User.is_onboarding).filter(User.telegram_id == telegram_id).first()
+        
+        if not row:
+            return None
+        
+        _onboarding_state.set(telegram_id, row.is_onboarding)
+        return row.is_onboarding
+    
+    async def is_user_onboarding(self, telegram_id: int) -> bool:
         """Check if user is currently in onboarding mode."""
-        with get_session() as session:
-            user = session.query(User).filter(User.telegram_id == telegram_id).first()
-            if not user:
-                return True  # New user should start onboarding
-            return user.is_onboarding
+        state = await self.get_onboarding_state(telegram_id)
+        if state is None:
+            return True  # New user should start onboarding
+        return state
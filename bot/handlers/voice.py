@@ -1,12 +1,18 @@
+import asyncio
 import logging
-from telegram import Update
+from typing import Optional
+from telegram import File, Update, Voice
 from telegram.ext import ContextTypes
 
-from ..database import get_session, User
 from ..services import SpeechService
+from ..utils import get_user_snapshot, UserSnapshot
+from ..utils.cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Telegram keeps file_unique_id stable across forwards and re-sends, so those skip the download too
+_transcripts_by_file = TTLCache(ttl=30 * 24 * 3600, maxsize=5000)
+
 
 class VoiceHandler:
     """Handler for voice messages."""
@@ -18,29 +24,64 @@ class VoiceHandler:
         self.chat_handler = chat_handler
         logger.info("VoiceHandler initialized")
     
-    def _user_has_all_curators(self, telegram_id: int) -> bool:
-        """Check if user has selected all curators."""
-        with get_session() as session:
-            user = session.query(User).filter(User.telegram_id == telegram_id).first()
-            if not user:
-                return False
-            return all([
-                user.selected_center,
-                user.selected_business,
-                user.selected_soul,
-                user.selected_body
-            ])
+    async def _get_ready_user(self, telegram_id: int) -> Optional[UserSnapshot]:
+        """Get the user's snapshot if they have selected all curators."""
+        # The snapshot is a database read, so keep it off the event loop
+        user = await asyncio.to_thread(get_user_snapshot, telegram_id)
+        return user if user and user.has_all_curators_selected() else None
+    
+    async def _prefetch_voice_file(self, context: ContextTypes.DEFAULT_TYPE, voice: Voice) -> Optional[File]:
+        """Resolve the voice file for download, unless it will not be needed."""
+        if voice.duration > self.MAX_DURATION_SECONDS or _transcripts_by_file.get(voice.file_unique_id) is not None:
+            return None
+        
+        try:
+            return await context.bot.get_file(voice.file_id)
+        except Exception as e:
+            # Retried inside the main flow, which reports errors to the user
+            logger.warning("Prefetching voice file failed: %s", e)
+            return None
+    
+    async def _transcribe_voice(
+        self,
+        context: ContextTypes.DEFAULT_TYPE,
+        voice: Voice,
+        voice_file: Optional[File] = None
+    ) -> str:
+        """Download and transcribe a voice message, reusing the transcript of a known file."""
+        transcribed_text = _transcripts_by_file.get(voice.file_unique_id)
+        if transcribed_text is not None:
+            logger.info("Transcript cache hit for voice file %s", voice.file_unique_id)
+            return transcribed_text
+        
+        # Get the voice file
+        if voice_file is None:
+            voice_file = await context.bot.get_file(voice.file_id)
+        logger.info("Voice file URL: %s", voice_file.file_path)
+        audio_bytes = bytes(await voice_file.download_as_bytearray())
+        
+        logger.info("Starting transcription...")
+        transcribed_text = await self.speech_service.transcribe_audio(audio_bytes, voice.duration)
+        if transcribed_text and transcribed_text.strip():
+            _transcripts_by_file.set(voice.file_unique_id, transcribed_text)
+        return transcribed_text
     
     async def handle_voice_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle incoming voice messages."""
         telegram_id = update.effective_user.id
         voice = update.message.voice
         
-        logger.info(f"Received voice message from user {telegram_id}, duration: {voice.duration}s")
+        logger.info("Received voice message from user %s, duration: %ss", telegram_id, voice.duration)
+        
+        # The curator lookup and getFile are independent, so overlap them
+        user, voice_file = await asyncio.gather(
+            self._get_ready_user(telegram_id),
+            self._prefetch_voice_file(context, voice)
+        )
         
         # Check if user has all curators selected
-        if not self._user_has_all_curators(telegram_id):
-            logger.warning(f"User {telegram_id} hasn't selected all curators yet")
+        if user is None:
+            logger.warning("User %s hasn't selected all curators yet", telegram_id)
             await update.message.reply_text(
                 "Пожалуйста, сначала выберите наставников для всех сфер. "
                 "Используйте команду /curators"
@@ -49,47 +90,46 @@ class VoiceHandler:
         
         # Check duration
         if voice.duration > self.MAX_DURATION_SECONDS:
-            logger.warning(f"Voice message too long: {voice.duration}s (max: {self.MAX_DURATION_SECONDS}s)")
+            logger.warning("Voice message too long: %ss (max: %ss)", voice.duration, self.MAX_DURATION_SECONDS)
             await update.message.reply_text(
                 f"Голосовое сообщение слишком длинное. "
                 f"Максимальная продолжительность: {self.MAX_DURATION_SECONDS} секунд."
             )
             return
         
+        status_message = None
+        transcript_shown = False
         try:
-            # Notify user about processing
-            await update.message.reply_text("🎤 Обрабатываю голосовое сообщение...")
-            
-            # Get the voice file
-            voice_file = await context.bot.get_file(voice.file_id)
-            voice_url = voice_file.file_path
-            
-            logger.info(f"Voice file URL: {voice_url}")
+            # Notify user about processing; this message is later edited into the result
+            status_message = await update.message.reply_text("🎤 Обрабатываю голосовое сообщение...")
             
             # Transcribe the audio
-            logger.info("Starting transcription...")
-            transcribed_text = await self.speech_service.transcribe_audio(voice_url)
+            transcribed_text = await self._transcribe_voice(context, voice, voice_file)
             
             if not transcribed_text or transcribed_text.strip() == "":
                 logger.warning("Transcription returned empty text")
-                await update.message.reply_text(
+                await status_message.edit_text(
                     "Не удалось распознать речь в голосовом сообщении. "
                     "Пожалуйста, попробуйте снова."
                 )
                 return
             
-            logger.info(f"Transcribed text: {transcribed_text[:100]}...")
+            logger.info("Transcribed text: %s...", transcribed_text[:100])
             
-            # Send transcription to user
-            await update.message.reply_text(f"📝 Распознано: {transcribed_text}")
+            # Show transcription to user in place of the processing notice
+            await status_message.edit_text(f"📝 Распознано: {transcribed_text}")
+            transcript_shown = True
             
-            # Process the transcribed text
-            await self.chat_handler.process_transcribed_text(update, context, transcribed_text)
+            # Process the transcribed text, reusing the snapshot loaded above
+            await self.chat_handler.process_transcribed_text(update, context, transcribed_text, user)
             
         except Exception as e:
-            logger.error(f"Error handling voice message: {e}", exc_info=True)
-            await update.message.reply_text(
-                f"Произошла ошибка при обработке голосового сообщения: {str(e)}"
-            )
+            logger.error("Error handling voice message: %s", e, exc_info=True)
+            error_text = f"Произошла ошибка при обработке голосового сообщения: {str(e)}"
+            # Once the status message shows the transcript, keep it and reply separately
+            if status_message and not transcript_shown:
+                await status_message.edit_text(error_text)
+            else:
+                await update.message.reply_text(error_text)
 
 
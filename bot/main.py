@@ -12,9 +12,10 @@ from telegram.ext import (
 )
 from telegram.request import HTTPXRequest
 
-from .database import init_db
+from .database import init_db, optimize_db
 from .services import AIService, SpeechService, SummarizationService
 from .handlers import OnboardingHandler, ChatHandler, CommandsHandler, VoiceHandler
+from .utils import TokenBucketRateLimiter, spawn_background
 
 # Load environment variables
 load_dotenv()
@@ -27,6 +28,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# How often SQLite planner statistics are refreshed
+OPTIMIZE_INTERVAL_SECONDS = 15 * 60
+
 
 class SborkaBot:
     """Main bot class that wires everything together."""
@@ -56,20 +60,23 @@ class SborkaBot:
         # Check for test environment
         self.use_test_env = os.getenv("USE_TG_TEST", "false").lower() == "true"
 
+        self._optimize_task = None
+
         logger.info("SborkaBot initialized successfully")
 
     async def _handle_message(self, update: Update, context):
         """Route messages based on user state."""
         telegram_id = update.effective_user.id
 
-        logger.info(f"Received message from user {telegram_id}")
+        logger.info("Received message from user %s", telegram_id)
 
         # Check if user is in onboarding
-        if self.onboarding_handler.is_user_onboarding(telegram_id):
-            logger.info(f"User {telegram_id} is in onboarding mode, handling as onboarding answer")
+        if await self.onboarding_handler.is_user_onboarding(telegram_id):
+            logger.info("User %s is in onboarding mode, handling as onboarding answer", telegram_id)
             await self.onboarding_handler.handle_text_answer(update, context)
             return
-        print('onboarding_handler', telegram_id)
+
+        logger.debug("User %s is past onboarding, handling as chat message", telegram_id)
         # Handle as regular chat message
         await self.chat_handler.handle_text_message(update, context)
 
@@ -77,11 +84,11 @@ class SborkaBot:
         """Handle voice messages."""
         telegram_id = update.effective_user.id
 
-        logger.info(f"Received voice message from user {telegram_id}")
+        logger.info("Received voice message from user %s", telegram_id)
 
         # Check if user is in onboarding
-        if self.onboarding_handler.is_user_onboarding(telegram_id):
-            logger.info(f"User {telegram_id} is in onboarding mode, ignoring voice")
+        if await self.onboarding_handler.is_user_onboarding(telegram_id):
+            logger.info("User %s is in onboarding mode, ignoring voice", telegram_id)
             await update.message.reply_text(
                 "Пожалуйста, сначала завершите тест личности."
             )
@@ -95,12 +102,12 @@ class SborkaBot:
         query = update.callback_query
         data = query.data
 
-        logger.info(f"Received callback: {data}")
+        logger.info("Received callback: %s", data)
 
         if data.startswith("poster_"):
             await self.commands_handler.handle_poster_callback(update, context)
         else:
-            logger.warning(f"Unknown callback data: {data}")
+            logger.warning("Unknown callback data: %s", data)
             await query.answer("Неизвестная команда")
 
     async def _error_handler(self, update: Update, context):
@@ -117,20 +124,49 @@ class SborkaBot:
             except Exception as e:
                 logger.error(f"Failed to send error message to user: {e}")
 
+    async def _periodic_optimize(self):
+        """Refresh SQLite query planner statistics in the background."""
+        while True:
+            await asyncio.sleep(OPTIMIZE_INTERVAL_SECONDS)
+            try:
+                await asyncio.to_thread(optimize_db)
+            except Exception as e:
+                logger.error(f"PRAGMA optimize failed: {e}")
+
+    async def _post_init(self, application: Application):
+        """Start background maintenance once the application is initialized."""
+        self._optimize_task = asyncio.create_task(self._periodic_optimize())
+        spawn_background(self.ai_service.warm_up(), name="gemini-warm-up")
+
+    async def _post_shutdown(self, application: Application):
+        """Stop background maintenance and leave fresh statistics behind."""
+        if self._optimize_task:
+            self._optimize_task.cancel()
+        try:
+            await asyncio.to_thread(optimize_db)
+        except Exception as e:
+            logger.error(f"PRAGMA optimize on shutdown failed: {e}")
+
     def run(self):
         """Run the bot."""
         logger.info("Starting bot...")
         logger.info(f"USE_TG_TEST: {self.use_test_env}")
 
-        # Build application with increased timeouts
+        # Build application with increased timeouts; one shared keep-alive pool serves all
+        # Bot API calls and file downloads, and bursts wait for a free connection
         request = HTTPXRequest(
+            connection_pool_size=256,
             read_timeout=60,
             write_timeout=60,
             connect_timeout=30,
+            pool_timeout=5.0,
         )
         builder = (Application.builder()
                 .token(self.bot_token)
-                .request(request))
+                .request(request)
+                .rate_limiter(TokenBucketRateLimiter())
+                .post_init(self._post_init)
+                .post_shutdown(self._post_shutdown))
 
         # Use test environment if configured
         if self.use_test_env:
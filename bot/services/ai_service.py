@@ -1,7 +1,7 @@
 import os
-import re
 import json
 import base64
+import hashlib
 import logging
 import asyncio
 from typing import Optional
@@ -9,8 +9,15 @@ from typing import Optional
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
+from ..utils.cache import TTLCache
+
 logger = logging.getLogger(__name__)
 
+# Responses keyed by a hash of the exact prompt and generation settings
+_response_cache = TTLCache(ttl=3600, maxsize=1000)
+
+_json_decoder = json.JSONDecoder()
+
 
 class AIService:
     """Service for interacting with Google Gemini AI API."""
@@ -20,6 +27,8 @@ class AIService:
     def __init__(self):
         self.model_name = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
         self.model_fallback = os.getenv("GEMINI_MODEL_FALLBACK", "gemini-1.5-flash")
+        # Query both models at once and take the first answer; doubles API usage, so opt-in
+        self.speculative = os.getenv("GEMINI_SPECULATIVE", "false").lower() == "true"
         self.safety_settings = {
             HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
             HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
@@ -27,6 +36,9 @@ class AIService:
             HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
         }
         self._configure_api()
+        # Model objects are reused across requests instead of being rebuilt on every call
+        self._model = self._build_model(self.model_name)
+        self._model_fallback = self._build_model(self.model_fallback)
     
     def _configure_api(self):
         """Configure Gemini API with API key (only once)."""
@@ -43,31 +55,52 @@ class AIService:
             AIService._configured = True
             logger.info("Gemini API configured successfully")
         except Exception as e:
-            logger.error(f"Gemini configuration error: {e}")
+            logger.error("Gemini configuration error: %s", e)
     
-    def _get_model(self, use_fallback: bool = False) -> Optional[genai.GenerativeModel]:
-        """Get Gemini model instance with fallback support."""
+    def _build_model(self, model_name: str) -> Optional[genai.GenerativeModel]:
+        """Create a Gemini model instance, or None if it cannot be initialized."""
         try:
-            model_name = self.model_fallback if use_fallback else self.model_name
             return genai.GenerativeModel(
                 model_name=model_name,
                 safety_settings=self.safety_settings
             )
         except Exception as e:
-            logger.error(f"Error initializing model: {e}")
+            logger.error("Error initializing model %s: %s", model_name, e)
             return None
     
+    def _get_model(self, use_fallback: bool = False) -> Optional[genai.GenerativeModel]:
+        """Get Gemini model instance with fallback support."""
+        return self._model_fallback if use_fallback else self._model
+    
+    async def warm_up(self):
+        """Make one cheap API call so the first user request does not pay for connection setup."""
+        if not AIService._configured or not self._model:
+            return
+        
+        try:
+            await asyncio.to_thread(self._model.count_tokens, "warmup")
+            logger.info("Gemini model %s warmed up", self.model_name)
+        except Exception as e:
+            logger.warning("Gemini warm-up failed: %s", e)
+    
     def _clean_json_string(self, text: str) -> str:
         """Remove markdown code blocks from JSON response."""
-        text = re.sub(r"```json\s*", "", text)
-        text = re.sub(r"```\s*", "", text)
+        text = text.strip()
+        if text.startswith("```json"):
+            text = text[7:]
+        elif text.startswith("```"):
+            text = text[3:]
+        if text.endswith("```"):
+            text = text[:-3]
         return text.strip()
     
     async def generate_response(
         self, 
         prompt: str, 
         system_instruction: Optional[str] = None,
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        use_cache: bool = True,
+        response_mime_type: Optional[str] = None
     ) -> str:
         """
         Generate a text response from Gemini.
@@ -76,42 +109,66 @@ class AIService:
             prompt: The user prompt
             system_instruction: Optional system instruction
             temperature: Generation temperature (0.0-1.0)
+            use_cache: Return an earlier response to an identical prompt if one is cached
+            response_mime_type: Optional output format, e.g. "application/json"
             
         Returns:
             The AI response as a string
         """
-        logger.info(f"Generating AI response for prompt (length: {len(prompt)})")
+        logger.info("Generating AI response for prompt (length: %s)", len(prompt))
+        
+        full_prompt = prompt
+        if system_instruction:
+            full_prompt = f"{system_instruction}\n\n{prompt}"
+        
+        generation_config = {"temperature": temperature}
+        if response_mime_type:
+            generation_config["response_mime_type"] = response_mime_type
+        
+        cache_key = hashlib.sha256(
+            f"{temperature}\0{response_mime_type}\0{full_prompt}".encode("utf-8")
+        ).hexdigest()
+        cached_result = _response_cache.get(cache_key) if use_cache else None
+        if cached_result is not None:
+            logger.info("Serving AI response from cache")
+            return cached_result
         
         model = self._get_model(use_fallback=False)
         if not model:
             return "AI service not configured."
         
-        full_prompt = prompt
-        if system_instruction:
-            full_prompt = f"{system_instruction}\n\n{prompt}"
+        speculative = self.speculative and self._model_fallback is not None
         
-        logger.debug(f"Prompt: {full_prompt}")
+        logger.debug("Prompt: %s", full_prompt)
         try:
-            response = await asyncio.to_thread(
-                model.generate_content,
-                full_prompt,
-                generation_config={"temperature": temperature}
-            )
+            if speculative:
+                response = await self._generate_speculative(model, full_prompt, generation_config)
+            else:
+                response = await asyncio.to_thread(
+                    model.generate_content,
+                    full_prompt,
+                    generation_config=generation_config
+                )
             
             if not response.parts:
-                logger.error(f"Safety block: {response.prompt_feedback}")
+                logger.error("Safety block: %s", response.prompt_feedback)
                 return "Request blocked by safety filters. Please rephrase."
             
             result = response.text
-            logger.info(f"Received AI response (length: {len(result)})")
-            logger.debug(f"Response preview: {result[:200]}...")
+            logger.info("Received AI response (length: %s)", len(result))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response preview: %s...", result[:200])
+            _response_cache.set(cache_key, result)
             return result
             
         except Exception as e:
-            logger.error(f"Primary model failed: {e}")
+            logger.error("Primary model failed: %s", e)
+            if speculative:
+                # The fallback model has already been tried alongside the primary
+                raise
             
             # Try fallback model
-            logger.info(f"Trying fallback model: {self.model_fallback}")
+            logger.info("Trying fallback model: %s", self.model_fallback)
             model_fallback = self._get_model(use_fallback=True)
             
             if model_fallback:
@@ -119,14 +176,51 @@ class AIService:
                     response = await asyncio.to_thread(
                         model_fallback.generate_content,
                         full_prompt,
-                        generation_config={"temperature": temperature}
+                        generation_config=generation_config
                     )
-                    return response.text
+                    result = response.text
+                    _response_cache.set(cache_key, result)
+                    return result
                 except Exception as e2:
-                    logger.error(f"Fallback model also failed: {e2}")
+                    logger.error("Fallback model also failed: %s", e2)
             
             raise
     
+    async def _generate_speculative(self, model: genai.GenerativeModel, full_prompt: str, generation_config: dict):
+        """
+        Run the prompt on the primary and the fallback model at once.
+        
+        Args:
+            model: The primary model
+            full_prompt: The prompt including any system instruction
+            generation_config: Generation settings passed to both models
+            
+        Returns:
+            The first successful response, preferring the primary one when both are ready
+        """
+        primary = asyncio.create_task(asyncio.to_thread(
+            model.generate_content, full_prompt, generation_config=generation_config
+        ))
+        fallback = asyncio.create_task(asyncio.to_thread(
+            self._model_fallback.generate_content, full_prompt, generation_config=generation_config
+        ))
+        pending = {primary, fallback}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda t: t is not primary):
+                    if task.exception() is None:
+                        if task is fallback:
+                            logger.info("Fallback model %s answered first", self.model_fallback)
+                        return task.result()
+                    logger.warning("Speculative call failed: %s", task.exception())
+        finally:
+            # The worker thread still finishes, but its result is discarded
+            for task in pending:
+                task.cancel()
+        
+        raise primary.exception()
+    
     async def generate_json_response(self, prompt: str, max_retries: int = 3) -> dict:
         """
         Generate a JSON response from Gemini with retry logic.
@@ -138,26 +232,34 @@ class AIService:
         Returns:
             Parsed JSON response as dictionary
         """
-        logger.info(f"Generating JSON response with max {max_retries} retries")
+        logger.info("Generating JSON response with max %s retries", max_retries)
         
         for attempt in range(max_retries):
-            logger.info(f"Attempt {attempt + 1}/{max_retries} to get valid JSON")
+            logger.info("Attempt %s/%s to get valid JSON", attempt + 1, max_retries)
             
             try:
-                response = await self.generate_response(prompt, temperature=0.1)
+                # A retry must not get the same unparseable response back from the cache
+                response = await self.generate_response(
+                    prompt,
+                    temperature=0.1,
+                    use_cache=attempt == 0,
+                    response_mime_type="application/json"
+                )
                 clean_text = self._clean_json_string(response)
-                result = json.loads(clean_text)
-                logger.info(f"Successfully parsed JSON on attempt {attempt + 1}")
+                # raw_decode stops at the end of the JSON value, so trailing model
+                # commentary does not cost another round-trip
+                result, _ = _json_decoder.raw_decode(clean_text)
+                logger.info("Successfully parsed JSON on attempt %s", attempt + 1)
                 return result
                 
             except json.JSONDecodeError as e:
-                logger.warning(f"JSON parsing failed on attempt {attempt + 1}: {e}")
+                logger.warning("JSON parsing failed on attempt %s: %s", attempt + 1, e)
                 if attempt == max_retries - 1:
                     logger.error("Max retries reached, could not parse JSON")
                     raise ValueError(f"Failed to parse JSON after {max_retries} attempts: {e}")
                     
             except Exception as e:
-                logger.error(f"Error on attempt {attempt + 1}: {e}", exc_info=True)
+                logger.error("Error on attempt %s: %s", attempt + 1, e, exc_info=True)
                 if attempt == max_retries - 1:
                     raise
         
@@ -173,7 +275,7 @@ class AIService:
         Returns:
             Image bytes
         """
-        logger.info(f"Generating image with prompt (length: {len(prompt)})")
+        logger.info("Generating image with prompt (length: %s)", len(prompt))
         
         try:
             # Use gemini-3-pro-image-preview model for image generation
@@ -185,7 +287,7 @@ class AIService:
             )
             
             if not response.parts:
-                logger.error(f"Image generation blocked: {response.prompt_feedback}")
+                logger.error("Image generation blocked: %s", response.prompt_feedback)
                 raise ValueError("Image generation blocked by safety filters")
             
             # Check if response contains image
@@ -197,11 +299,12 @@ class AIService:
                     elif hasattr(part, 'text') and part.text:
                         # Sometimes Gemini returns base64 encoded image in text
                         try:
-                            # Try to decode as base64
-                            image_data = base64.b64decode(part.text)
+                            # Try to decode as base64; validate rejects plain text up front
+                            # instead of decoding it into junk bytes
+                            image_data = base64.b64decode(part.text, validate=True)
                             logger.info("Decoded image from base64 text")
                             return image_data
-                        except:
+                        except ValueError:
                             pass
             
             # Alternative: check if response has images
@@ -217,5 +320,5 @@ class AIService:
             raise ValueError("No image data in response")
             
         except Exception as e:
-            logger.error(f"Image generation failed: {e}", exc_info=True)
+            logger.error("Image generation failed: %s", e, exc_info=True)
             raise
\ No newline at end of file
@@ -1,10 +1,20 @@
 import os
+import io
+import asyncio
+import hashlib
 import logging
 import replicate
 from typing import Optional
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from ..database import get_session, get_read_session, Transcript
+from ..utils.cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Transcripts keyed by SHA-256 of the audio, so forwarded or re-sent voices skip Whisper
+_transcript_cache = TTLCache(ttl=7 * 24 * 3600, maxsize=1000)
+
 
 class SpeechService:
     """Service for speech-to-text conversion using Replicate API."""
@@ -17,32 +27,64 @@ class SpeechService:
         if not self.token:
             logger.warning("REPLICATE_TOKEN not set in environment variables")
         else:
-            os.environ["REPLICATE_API_TOKEN"] = self.token
             logger.info("SpeechService initialized with Replicate token")
+        # One client for the service lifetime, so its HTTP connections are kept alive between calls
+        self._client = replicate.Client(api_token=self.token)
+    
+    @staticmethod
+    def _batch_size_for(duration_seconds: Optional[int]) -> int:
+        """Pick a Whisper batch size that fits the clip instead of always reserving 64 slots."""
+        if duration_seconds is None:
+            return 64
+        if duration_seconds < 15:
+            return 8
+        if duration_seconds < 40:
+            return 24
+        return 64
     
-    async def transcribe_audio(self, audio_url: str) -> str:
+    async def transcribe_audio(self, audio_bytes: bytes, duration_seconds: Optional[int] = None) -> str:
         """
         Transcribe audio to text using Whisper model.
         
+        Identical audio is transcribed only once; later requests are served
+        from an in-process cache keyed by the content hash, backed by the
+        transcripts table so results survive restarts.
+        
         Args:
-            audio_url: URL to the audio file
+            audio_bytes: Contents of the OGG voice file
+            duration_seconds: Length of the audio, used to size the Whisper batch
             
         Returns:
             Transcribed text
         """
-        logger.info(f"Starting transcription for audio: {audio_url}")
+        audio_hash = hashlib.sha256(audio_bytes).hexdigest()
+        cached_text = _transcript_cache.get(audio_hash)
+        if cached_text is not None:
+            logger.info("Transcription cache hit for audio %s", audio_hash[:12])
+            return cached_text
+        
+        stored_text = await asyncio.to_thread(self._load_transcript, audio_hash)
+        if stored_text is not None:
+            logger.info("Stored transcript found for audio %s", audio_hash[:12])
+            _transcript_cache.set(audio_hash, stored_text)
+            return stored_text
+        
+        logger.info("Starting transcription for audio %s (%s bytes)", audio_hash[:12], len(audio_bytes))
         
         try:
+            # Upload the bytes we already have instead of letting Replicate fetch them again
+            audio_file = io.BytesIO(audio_bytes)
+            audio_file.name = "voice.ogg"
             input_data = {
-                "audio": audio_url,
-                "batch_size": 64,
+                "audio": audio_file,
+                "batch_size": self._batch_size_for(duration_seconds),
                 "language": "russian",
                 "task": "transcribe"
             }
             
             logger.info("Sending request to Replicate API (vaibhavs10/incredibly-fast-whisper)")
             
-            output = replicate.run(
+            output = await self._client.async_run(
                 "vaibhavs10/incredibly-fast-whisper:3ab86df6c8f54c11309d4d1f930ac292bad43ace52d10c80d87eb258b3c9f79c",
                 input=input_data
             )
@@ -50,17 +92,39 @@ class SpeechService:
             # Output format: {"text": "transcribed text", "chunks": [...]}
             if isinstance(output, dict) and "text" in output:
                 text = output["text"]
-                logger.info(f"Successfully transcribed audio (length: {len(text)})")
-                logger.debug(f"Transcription preview: {text[:200]}...")
+                logger.info("Successfully transcribed audio (length: %s)", len(text))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Transcription preview: %s...", text[:200])
+                if text.strip():
+                    _transcript_cache.set(audio_hash, text)
+                    await asyncio.to_thread(self._store_transcript, audio_hash, text)
                 return text
             else:
-                logger.warning(f"Unexpected output format: {output}")
+                logger.warning("Unexpected output format: %s", output)
                 return str(output)
                 
         except Exception as e:
-            logger.error(f"Error transcribing audio: {e}", exc_info=True)
+            logger.error("Error transcribing audio: %s", e, exc_info=True)
             raise
     
+    def _load_transcript(self, audio_hash: str) -> Optional[str]:
+        """Read a stored transcript for the audio hash, if any."""
+        with get_read_session() as session:
+            row = session.query(Transcript.text).filter(Transcript.audio_hash == audio_hash).first()
+        return row.text if row else None
+    
+    def _store_transcript(self, audio_hash: str, text: str):
+        """Persist a transcript; a failure only costs a future cache miss."""
+        try:
+            with get_session() as session:
+                session.execute(
+                    sqlite_insert(Transcript)
+                    .values(audio_hash=audio_hash, text=text)
+                    .on_conflict_do_nothing(index_elements=["audio_hash"])
+                )
+        except Exception as e:
+            logger.warning("Could not store transcript %s: %s", audio_hash[:12], e)
+    
     def is_duration_valid(self, duration_seconds: int) -> bool:
         """
         Check if the audio duration is within allowed limits.
@@ -72,7 +136,7 @@ class SpeechService:
             True if duration is valid, False otherwise
         """
         is_valid = duration_seconds <= self.MAX_DURATION_SECONDS
-        logger.info(f"Duration check: {duration_seconds}s (max: {self.MAX_DURATION_SECONDS}s) - valid: {is_valid}")
+        logger.info("Duration check: %ss (max: %ss) - valid: %s", duration_seconds, self.MAX_DURATION_SECONDS, is_valid)
         return is_valid
 
 
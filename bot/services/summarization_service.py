@@ -1,11 +1,16 @@
 import os
 import logging
 import asyncio
-from typing import Optional, List
-from jinja2 import Template
 from datetime import datetime
+from typing import Dict, Optional, List, Tuple
+from jinja2 import Template
+from sqlalchemy import func
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
 
-from ..database import get_session, Message, Summarization, User
+from ..database import get_session, get_read_session, Message, Summarization, User
+from ..utils.helpers import format_transcript
+from ..utils.jinja_env import prompt_env
 from .ai_service import AIService
 
 logger = logging.getLogger(__name__)
@@ -17,21 +22,31 @@ CONTENT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__fil
 class SummarizationService:
     """Service for summarizing conversation history."""
     
-    # Summarize after these many message pairs (user + assistant)
-    FIRST_SUMMARIZATION_THRESHOLD = 3
-    REGULAR_SUMMARIZATION_THRESHOLD = 10
+    # Summarize once the unsummarized history reaches this share of the token budget
+    DEFAULT_TOKEN_BUDGET = 4096
+    BUDGET_SHARE = 0.8
+    # Rough token estimate: about 4 characters per token
+    CHARS_PER_TOKEN = 4
+    
+    # Switched off for now; prompts use the raw sphere histories instead
+    SUMMARIZATION_ENABLED = False
     
     def __init__(self, ai_service: AIService):
         self.ai_service = ai_service
+        self.token_budget = int(os.getenv("SUMM_TOKEN_BUDGET", self.DEFAULT_TOKEN_BUDGET))
+        self.token_threshold = int(self.token_budget * self.BUDGET_SHARE)
+        self._summarization_template: Optional[Template] = None
+        # (user_id, sphere) -> estimated tokens still needed before the DB is checked again.
+        # Only touched from the event loop thread, so no lock is needed.
+        self._tokens_until_check: Dict[Tuple[int, str], int] = {}
         logger.info("SummarizationService initialized")
     
-    def _load_summarization_prompt(self) -> str:
-        """Load the summarization prompt template."""
-        prompt_path = os.path.join(CONTENT_DIR, "summarization.txt")
-        logger.debug(f"Loading summarization prompt from: {prompt_path}")
-        
-        with open(prompt_path, "r", encoding="utf-8") as f:
-            return f.read()
+    def _get_summarization_template(self) -> Template:
+        """Get the compiled summarization prompt template, loading it on first use."""
+        if self._summarization_template is None:
+            logger.debug(f"Loading summarization prompt from: {os.path.join(CONTENT_DIR, 'summarization.txt')}")
+            self._summarization_template = prompt_env.get_template("summarization.txt")
+        return self._summarization_template
     
     def _get_message_count(self, user_id: int, sphere: str) -> int:
         """Get the count of message pairs for a user in a specific sphere."""
@@ -73,55 +88,99 @@ class SummarizationService:
             return summarization.text
         return "no data"
     
-    def _get_messages_since_last_summarization(self, user_id: int, sphere: str) -> List[Message]:
-        """Get all messages since the last summarization."""
-        with get_session() as session:
-            # Query last summarization within same session to avoid detached instance error
-            last_sum = session.query(Summarization).filter(
-                Summarization.user_id == user_id,
-                Summarization.sphere == sphere
-            ).order_by(Summarization.created_at.desc()).first()
-            
-            query = session.query(Message).filter(
-                Message.user_id == user_id,
-                Message.sphere == sphere
-            )
-            
-            if last_sum:
-                query = query.filter(Message.created_at > last_sum.created_at)
-            
-            messages = query.order_by(Message.created_at.asc()).all()
-            logger.debug(f"Found {len(messages)} messages since last summarization for user {user_id} in {sphere}")
+    def note_messages(self, user_id: int, sphere: str, *contents: str):
+        """Record stored messages so the next check can skip the DB while under the threshold."""
+        key = (user_id, sphere)
+        if key in self._tokens_until_check:
+            self._tokens_until_check[key] -= sum(map(len, contents)) // self.CHARS_PER_TOKEN
+    
+    def _fetch_summarization_state(
+        self,
+        session: Session,
+        user_id: int,
+        sphere: str
+    ) -> Tuple[Optional[datetime], int]:
+        """
+        Load what the summarization check needs, without loading any message rows.
+        
+        Args:
+            session: Session to query with
+            user_id: The user's database ID
+            sphere: The sphere to check
             
-            # Detach messages from session before returning
-            return [
-                Message(
-                    id=m.id,
-                    user_id=m.user_id,
-                    sphere=m.sphere,
-                    role=m.role,
-                    content=m.content,
-                    created_at=m.created_at
-                ) for m in messages
-            ]
+        Returns:
+            Tuple of (creation time of the last summarization or None,
+            estimated tokens of the messages since then)
+        """
+        last_sum_at = session.query(Summarization.created_at).filter(
+            Summarization.user_id == user_id,
+            Summarization.sphere == sphere
+        ).order_by(Summarization.created_at.desc()).limit(1).scalar()
+        
+        chars = self._count_chars_since(session, user_id, sphere, last_sum_at)
+        
+        tokens = chars // self.CHARS_PER_TOKEN
+        logger.debug(f"Found ~{tokens} tokens since last summarization for user {user_id} in {sphere}")
+        return last_sum_at, tokens
+    
+    def _count_chars_since(
+        self,
+        session: Session,
+        user_id: int,
+        sphere: str,
+        since: Optional[datetime]
+    ) -> int:
+        """Sum the content length of a sphere's messages created after `since` (all of them if None)."""
+        query = session.query(func.coalesce(func.sum(func.length(Message.content)), 0)).filter(
+            Message.user_id == user_id,
+            Message.sphere == sphere
+        )
+        if since is not None:
+            query = query.filter(Message.created_at > since)
+        return query.scalar()
     
-    def should_summarize(self, user_id: int, sphere: str) -> bool:
-        return False
-        """Check if summarization should be performed."""
-        messages = self._get_messages_since_last_summarization(user_id, sphere)
-        user_messages = [m for m in messages if m.role == "user"]
-        count = len(user_messages)
+    def _get_messages_since(
+        self,
+        session: Session,
+        user_id: int,
+        sphere: str,
+        since: Optional[datetime]
+    ) -> List[Row]:
+        """Get the messages of a sphere created after `since` as (id, role, content, created_at) rows."""
+        query = session.query(
+            Message.id,
+            Message.role,
+            Message.content,
+            Message.created_at
+        ).filter(
+            Message.user_id == user_id,
+            Message.sphere == sphere
+        )
         
-        # Check if we have an existing summarization
-        has_previous = self._get_last_summarization(user_id, sphere) is not None
+        if since is not None:
+            query = query.filter(Message.created_at > since)
         
-        if has_previous:
-            should = count >= self.REGULAR_SUMMARIZATION_THRESHOLD
-        else:
-            should = count >= self.FIRST_SUMMARIZATION_THRESHOLD
+        return query.order_by(Message.id.asc()).all()
+    
+    def should_summarize(
+        self,
+        user_id: int,
+        sphere: str,
+        state: Optional[Tuple[Optional[datetime], int]] = None
+    ) -> bool:
+        """Check if summarization should be performed, reusing a prefetched state if given."""
+        if not self.SUMMARIZATION_ENABLED:
+            return False
+        
+        if state is None:
+            with get_read_session() as session:
+                state = self._fetch_summarization_state(session, user_id, sphere)
+        
+        last_sum_at, tokens = state
+        should = tokens >= self.token_threshold
         
         logger.info(f"Summarization check for user {user_id} in {sphere}: "
-                   f"count={count}, has_previous={has_previous}, should_summarize={should}")
+                   f"tokens~{tokens}, has_previous={last_sum_at is not None}, should_summarize={should}")
         return should
     
     async def summarize(self, user_id: int, sphere: str, max_retries: int = 3) -> Optional[str]:
@@ -138,28 +197,38 @@ class SummarizationService:
         """
         logger.info(f"Starting summarization for user {user_id} in sphere {sphere}")
         
-        if not self.should_summarize(user_id, sphere):
+        if not self.SUMMARIZATION_ENABLED:
             logger.info("Summarization not needed at this time")
             return None
         
-        # Get messages to summarize
-        messages = self._get_messages_since_last_summarization(user_id, sphere)
+        # Unknown keys (e.g. after a restart) fall through to the authoritative DB count
+        key = (user_id, sphere)
+        if self._tokens_until_check.get(key, 0) > 0:
+            logger.debug(f"Summarization check skipped for user {user_id} in {sphere}: "
+                        f"~{self._tokens_until_check[key]} tokens to go")
+            return None
+        
+        # Both reads share one session; the insert below gets its own, since
+        # a session must not stay open across the AI call
+        with get_read_session() as session:
+            # The check only counts; message rows are loaded once it passes
+            state = self._fetch_summarization_state(session, user_id, sphere)
+            if not self.should_summarize(user_id, sphere, state):
+                self._tokens_until_check[key] = self.token_threshold - state[1]
+                logger.info("Summarization not needed at this time")
+                return None
+            
+            messages = self._get_messages_since(session, user_id, sphere, state[0])
         
         if not messages:
             logger.warning("No messages to summarize")
             return None
         
         # Build history string
-        history_lines = []
-        for msg in messages:
-            role_label = "User" if msg.role == "user" else "Assistant"
-            history_lines.append(f"{role_label}: {msg.content}")
-        history = "\n".join(history_lines)
+        history = format_transcript(messages)
         
-        # Load and render prompt template
-        prompt_template = self._load_summarization_prompt()
-        template = Template(prompt_template)
-        prompt = template.render(history=history)
+        # Render the compiled prompt template
+        prompt = self._get_summarization_template().render(history=history)
         
         # Retry logic with exponential backoff
         last_error = None
@@ -173,11 +242,11 @@ class SummarizationService:
                     summarization = Summarization(
                         user_id=user_id,
                         sphere=sphere,
-                        text=summary_text,
-                        created_at=datetime.utcnow()
+                        text=summary_text
                     )
                     session.add(summarization)
                 
+                self._tokens_until_check[key] = self.token_threshold
                 logger.info(f"Summarization saved for user {user_id} in sphere {sphere}")
                 return summary_text
                 
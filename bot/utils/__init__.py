@@ -7,9 +7,14 @@ from .helpers import (
     update_user_thread,
     get_sphere_by_thread,
     get_all_spheres_history,
+    format_transcript,
     get_help_text,
     CONTENT_DIR
 )
+from .background import spawn_background
+from .rate_limiter import TokenBucketRateLimiter
+from .keyboards import CURATORS_MESSAGE_TEXT, get_curator_page_url, build_curators_keyboard
+from .user_cache import UserSnapshot, get_user_snapshot
 
 __all__ = [
     'get_or_create_user',
@@ -20,8 +25,16 @@ __all__ = [
     'update_user_thread',
     'get_sphere_by_thread',
     'get_all_spheres_history',
+    'format_transcript',
     'get_help_text',
-    'CONTENT_DIR'
+    'CONTENT_DIR',
+    'UserSnapshot',
+    'get_user_snapshot',
+    'spawn_background',
+    'CURATORS_MESSAGE_TEXT',
+    'get_curator_page_url',
+    'build_curators_keyboard',
+    'TokenBucketRateLimiter'
 ]
 
 
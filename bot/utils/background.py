@@ -0,0 +1,44 @@
+import asyncio
+import logging
+from typing import Coroutine, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on background jobs running at the same time
+MAX_BACKGROUND_TASKS = 16
+
+_semaphore = asyncio.Semaphore(MAX_BACKGROUND_TASKS)
+_tasks: Set[asyncio.Task] = set()
+
+
+async def _run_bounded(coro: Coroutine):
+    async with _semaphore:
+        return await coro
+
+
+def _on_task_done(task: asyncio.Task):
+    _tasks.discard(task)
+    if task.cancelled():
+        return
+    
+    error = task.exception()
+    if error:
+        logger.error(f"Background task {task.get_name()} failed: {error}", exc_info=error)
+
+
+def spawn_background(coro: Coroutine, name: Optional[str] = None) -> asyncio.Task:
+    """
+    Run a coroutine off the reply path with bounded concurrency.
+    
+    Args:
+        coro: The coroutine to run
+        name: Optional task name used in log messages
+        
+    Returns:
+        The scheduled task
+    """
+    task = asyncio.create_task(_run_bounded(coro), name=name)
+    # Keep a strong reference so the task is not garbage collected mid-flight
+    _tasks.add(task)
+    task.add_done_callback(_on_task_done)
+    return task
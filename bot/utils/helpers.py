@@ -1,38 +1,51 @@
 import os
+import re
 import json
 import logging
-from typing import Optional, List, Dict, Any
-from jinja2 import Template
+from functools import lru_cache
+from typing import Optional, List, Dict, Any, Iterable
+from jinja2 import Template, TemplateNotFound
+from sqlalchemy import func, select
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session, make_transient
 
-from ..database import get_session, User, Message, Summarization
+from ..database import get_session, get_read_session, User, Message, Summarization
+from .jinja_env import prompt_env
 
 logger = logging.getLogger(__name__)
 
 # Content directory path
 CONTENT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "content")
 
+# Transcript labels by message role; any other role is the assistant
+_ROLE_LABELS = {"user": "User"}
+_ALL_SPHERES_ROLE_LABELS = {"user": "USER"}
+
+
+HELP_TEXT = (
+    "🤖 <b>Команды бота</b>\n\n"
+    "/start - Начать работу с ботом\n"
+    "/reset_goals - Установить свои цели заново\n"
+    "/curators - Выбрать наставников\n"
+    "/poster - Сгенерировать персональный постер\n"
+    "/help - Показать это сообщение\n\n"
+    "<b>Как использовать</b>\n\n"
+    "1. Пройдите тест личности\n"
+    "2. Выберите наставников для каждой сферы\n"
+    "3. Общайтесь с наставниками в соответствующих топиках:\n"
+    "   - 🎯 Штаб - общая координация\n"
+    "   - 💼 Дело - бизнес и карьера\n"
+    "   - 🧘 Душа - эмоции и внутренний мир\n"
+    "   - 💪 Тело - здоровье и физическая форма\n"
+    "4. Используйте /poster для генерации персонального постера\n"
+    "   на основе вашей истории общения с наставниками\n\n"
+    "Вы можете отправлять текстовые и голосовые сообщения (до 1 минуты)."
+)
+
 
 def get_help_text() -> str:
     """Get the help message text."""
-    return (
-        "🤖 <b>Команды бота</b>\n\n"
-        "/start - Начать работу с ботом\n"
-        "/reset_goals - Установить свои цели заново\n"
-        "/curators - Выбрать наставников\n"
-        "/poster - Сгенерировать персональный постер\n"
-        "/help - Показать это сообщение\n\n"
-        "<b>Как использовать</b>\n\n"
-        "1. Пройдите тест личности\n"
-        "2. Выберите наставников для каждой сферы\n"
-        "3. Общайтесь с наставниками в соответствующих топиках:\n"
-        "   - 🎯 Штаб - общая координация\n"
-        "   - 💼 Дело - бизнес и карьера\n"
-        "   - 🧘 Душа - эмоции и внутренний мир\n"
-        "   - 💪 Тело - здоровье и физическая форма\n"
-        "4. Используйте /poster для генерации персонального постера\n"
-        "   на основе вашей истории общения с наставниками\n\n"
-        "Вы можете отправлять текстовые и голосовые сообщения (до 1 минуты)."
-    )
+    return HELP_TEXT
 
 
 def get_or_create_user(
@@ -46,10 +59,10 @@ def get_or_create_user(
     
     with get_session() as session:
         user = session.query(User).filter(User.telegram_id == telegram_id).first()
+        updated = False
         
         if user:
             logger.info(f"Found existing user: {user.id}")
-            updated = False
             
             # Update username if changed
             if username is not None and user.username != username:
@@ -68,35 +81,6 @@ def get_or_create_user(
                 user.last_name = last_name
                 updated = True
                 logger.info(f"Updated last_name to: {last_name}")
-            
-            if updated:
-                session.commit()
-            
-            # Create a detached copy
-            user_data = {
-                'id': user.id,
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'is_onboarding': user.is_onboarding,
-                'onboarding_step': user.onboarding_step,
-                'onboarding_answers': user.onboarding_answers,
-                'psychotype': user.psychotype,
-                'recommended_center': user.recommended_center,
-                'recommended_business': user.recommended_business,
-                'recommended_soul': user.recommended_soul,
-                'recommended_body': user.recommended_body,
-                'selected_center': user.selected_center,
-                'selected_business': user.selected_business,
-                'selected_soul': user.selected_soul,
-                'selected_body': user.selected_body,
-                'chat_id': user.chat_id,
-                'thread_soul': user.thread_soul,
-                'thread_body': user.thread_body,
-                'thread_business': user.thread_business,
-                'thread_center': user.thread_center,
-            }
         else:
             logger.info(f"Creating new user with telegram_id: {telegram_id}")
             user = User(
@@ -110,42 +94,19 @@ def get_or_create_user(
             )
             session.add(user)
             session.flush()
-            user_data = {
-                'id': user.id,
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'is_onboarding': user.is_onboarding,
-                'onboarding_step': user.onboarding_step,
-                'onboarding_answers': user.onboarding_answers,
-                'psychotype': user.psychotype,
-                'recommended_center': user.recommended_center,
-                'recommended_business': user.recommended_business,
-                'recommended_soul': user.recommended_soul,
-                'recommended_body': user.recommended_body,
-                'selected_center': user.selected_center,
-                'selected_business': user.selected_business,
-                'selected_soul': user.selected_soul,
-                'selected_body': user.selected_body,
-                'chat_id': user.chat_id,
-                'thread_soul': user.thread_soul,
-                'thread_body': user.thread_body,
-                'thread_business': user.thread_business,
-                'thread_center': user.thread_center,
-            }
-            logger.info(f"Created new user with id: {user_data['id']}")
-    
-    # Return a new detached user object with the data
-    detached_user = User()
-    for key, value in user_data.items():
-        setattr(detached_user, key, value)
-    
-    return detached_user
+            logger.info(f"Created new user with id: {user.id}")
+        
+        # Write pending changes, then detach the instance itself instead of copying every column.
+        # A transient object never lazy-loads, so unloaded columns read as None once the session closes.
+        session.flush()
+        make_transient(user)
+    
+    return user
 
 
+@lru_cache(maxsize=None)
 def load_onboarding_questions() -> List[Dict[str, Any]]:
-    """Load onboarding questions from JSON file."""
+    """Load onboarding questions from JSON file, once per process (do not mutate the result)."""
     questions_path = os.path.join(CONTENT_DIR, "onboarding.json")
     logger.info(f"Loading onboarding questions from: {questions_path}")
     
@@ -158,7 +119,7 @@ def load_onboarding_questions() -> List[Dict[str, Any]]:
 
 def load_curator_prompt(sphere: str, curator: Optional[str] = None) -> str:
     """
-    Load curator prompt template from file.
+    Load curator prompt template text from file.
     
     Args:
         sphere: The sphere (center, soul, body, business)
@@ -170,34 +131,31 @@ def load_curator_prompt(sphere: str, curator: Optional[str] = None) -> str:
     if not curator:
         raise ValueError(f"Curator label required for sphere: {sphere}")
     
-    prompt_path = os.path.join(CONTENT_DIR, "curators", sphere, f"{curator}.txt")
-    
-    logger.info(f"Loading curator prompt from: {prompt_path}")
-    
-    with open(prompt_path, "r", encoding="utf-8") as f:
-        return f.read()
+    # Same loader as the compiled curator templates, so there is one place that reads prompt files
+    try:
+        source, _, _ = prompt_env.loader.get_source(prompt_env, f"curators/{sphere}/{curator}.txt")
+    except TemplateNotFound:
+        prompt_path = os.path.join(CONTENT_DIR, "curators", sphere, f"{curator}.txt")
+        raise FileNotFoundError(f"Curator prompt not found: {prompt_path}") from None
+    return source
 
 
-def get_last_messages(user_id: int, sphere: str, limit: int = 10) -> List[Message]:
-    """Get the last N messages for a user in a specific sphere."""
+def get_last_messages(user_id: int, sphere: str, limit: int = 10) -> List[Row]:
+    """Get the last N messages for a user in a specific sphere as (id, role, content, created_at) rows."""
     with get_session() as session:
-        messages = session.query(Message).filter(
+        # Plain rows need no detaching and stay valid after the session closes
+        messages = session.query(
+            Message.id,
+            Message.role,
+            Message.content,
+            Message.created_at
+        ).filter(
             Message.user_id == user_id,
             Message.sphere == sphere
         ).order_by(Message.id.desc()).limit(limit).all()
         
-        # Reverse to get chronological order and detach
-        result = []
-        for m in reversed(messages):
-            msg = Message(
-                id=m.id,
-                user_id=m.user_id,
-                sphere=m.sphere,
-                role=m.role,
-                content=m.content,
-                created_at=m.created_at
-            )
-            result.append(msg)
+        # Reverse to get chronological order
+        result = messages[::-1]
         
         logger.debug(f"Retrieved {len(result)} messages for user {user_id} in {sphere}")
         return result
@@ -205,12 +163,7 @@ def get_last_messages(user_id: int, sphere: str, limit: int = 10) -> List[Messag
 
 def get_last_summarization_text(user_id: int, sphere: str) -> str:
     messages = get_last_messages(user_id, sphere, limit=500)
-    history_lines = []
-    for msg in messages:
-        role_label = "User" if msg.role == "user" else "Assistant"
-        history_lines.append(f"{role_label}: {msg.content}")
-    history = "\n".join(history_lines) if history_lines else "no data"
-    return history
+    return _format_sphere_history(messages)
     """Get the text of the last summarization for a sphere, or 'no data'."""
     with get_session() as session:
         summarization = session.query(Summarization).filter(
@@ -223,11 +176,76 @@ def get_last_summarization_text(user_id: int, sphere: str) -> str:
         return "no data"
 
 
-def build_sphere_prompt(user_id: int, sphere: str, curator: Optional[str] = None) -> str:
+@lru_cache(maxsize=None)
+def _get_curator_template(sphere: str, curator: str) -> Template:
+    """Compile a curator prompt template once per (sphere, curator)."""
+    if not curator:
+        raise ValueError(f"Curator label required for sphere: {sphere}")
+    
+    logger.info(f"Loading curator prompt template: curators/{sphere}/{curator}.txt")
+    return prompt_env.get_template(f"curators/{sphere}/{curator}.txt")
+
+
+def _get_recent_messages_by_sphere(
+    session: Session,
+    user_id: int,
+    spheres: Iterable[str],
+    limit: int = 500
+) -> Dict[str, List[Row]]:
+    """
+    Get the last `limit` messages of each sphere in one query, as (role, content) rows.
+    
+    Args:
+        session: An open database session
+        user_id: The user's database ID
+        spheres: The spheres to load
+        limit: Maximum number of messages per sphere
+        
+    Returns:
+        Dict of sphere -> its messages in chronological order
+    """
+    # Number each sphere's messages newest first, so the limit applies per sphere in SQL
+    ranked = select(
+        Message.id,
+        Message.sphere,
+        Message.role,
+        Message.content,
+        func.row_number().over(partition_by=Message.sphere, order_by=Message.id.desc()).label("rank")
+    ).where(
+        Message.user_id == user_id,
+        Message.sphere.in_(spheres)
+    ).subquery()
+    
+    rows = session.execute(
+        select(ranked.c.sphere, ranked.c.role, ranked.c.content)
+        .where(ranked.c.rank <= limit)
+        .order_by(ranked.c.id)
+    ).all()
+    
+    messages_by_sphere = {}
+    for row in rows:
+        messages_by_sphere.setdefault(row.sphere, []).append(row)
+    return messages_by_sphere
+
+
+def format_transcript(messages: Iterable[Any]) -> str:
+    """Format messages (anything with role and content) as 'User: ...' / 'Assistant: ...' lines."""
+    return "\n".join(f"{_ROLE_LABELS.get(msg.role, 'Assistant')}: {msg.content}" for msg in messages)
+
+
+def _format_sphere_history(messages: List[Row], limit: int = 500) -> str:
+    """Format the last `limit` messages of a sphere as a User/Assistant transcript."""
+    if not messages:
+        return "no data"
+    return format_transcript(messages[-limit:])
+
+
+def build_sphere_prompt(session: Session, user_id: int, sphere: str, curator: Optional[str] = None) -> str:
     """
     Build the complete prompt for a sphere conversation.
     
     Args:
+        session: An open database session
         user_id: The user's database ID
         sphere: The sphere (center, soul, body, business)
         curator: The curator label for the sphere
@@ -237,24 +255,22 @@ def build_sphere_prompt(user_id: int, sphere: str, curator: Optional[str] = None
     """
     logger.info(f"Building sphere prompt for user {user_id}, sphere: {sphere}, curator: {curator}")
     
-    # Load the curator prompt template
-    prompt_template = load_curator_prompt(sphere, curator)
+    # Load the compiled curator prompt template
+    template = _get_curator_template(sphere, curator)
     
-    # Get summarizations for all spheres
-    sum_soul = get_last_summarization_text(user_id, "soul")
-    sum_body = get_last_summarization_text(user_id, "body")
-    sum_business = get_last_summarization_text(user_id, "business")
+    # Load the last 500 messages of every sphere the prompt needs in one query
+    prompt_spheres = {"soul", "body", "business", sphere}
+    messages_by_sphere = _get_recent_messages_by_sphere(session, user_id, prompt_spheres)
     
-    # Get last 10 messages for this sphere
-    messages = get_last_messages(user_id, sphere, limit=500)
-    history_lines = []
-    for msg in messages:
-        role_label = "User" if msg.role == "user" else "Assistant"
-        history_lines.append(f"{role_label}: {msg.content}")
-    history = "\n".join(history_lines) if history_lines else "no data"
+    # Histories of the other spheres stand in for their summarizations
+    sum_soul = _format_sphere_history(messages_by_sphere.get("soul", []))
+    sum_body = _format_sphere_history(messages_by_sphere.get("body", []))
+    sum_business = _format_sphere_history(messages_by_sphere.get("business", []))
+    
+    # Get last 500 messages for this sphere
+    history = _format_sphere_history(messages_by_sphere.get(sphere, []))
     
     # Render the template
-    template = Template(prompt_template)
     prompt = template.render(
         sumSoul=sum_soul,
         sumBody=sum_body,
@@ -266,6 +282,18 @@ def build_sphere_prompt(user_id: int, sphere: str, curator: Optional[str] = None
     return prompt
 
 
+# Topic keyword -> sphere, matched in a single regex pass.
+# When a topic names several spheres, the keyword listed first here wins.
+_SPHERE_KEYWORDS = {
+    "душа": "soul",
+    "дело": "business",
+    "тело": "body",
+    "штаб": "center"
+}
+_SPHERE_KEYWORD_RE = re.compile("|".join(_SPHERE_KEYWORDS))
+_SPHERE_KEYWORD_RANK = {keyword: rank for rank, keyword in enumerate(_SPHERE_KEYWORDS)}
+
+
 def detect_sphere_from_topic(topic_name: Optional[str]) -> Optional[str]:
     """
     Detect the sphere from a topic name.
@@ -280,74 +308,83 @@ def detect_sphere_from_topic(topic_name: Optional[str]) -> Optional[str]:
         logger.debug("No topic name provided, cannot detect sphere")
         return None
     
-    topic_lower = topic_name.lower()
     logger.info(f"Detecting sphere from topic: {topic_name}")
     
-    sphere_mapping = {
-        "душа": "soul",
-        "дело": "business",
-        "тело": "body",
-        "штаб": "center"
-    }
-    
-    for keyword, sphere in sphere_mapping.items():
-        if keyword in topic_lower:
-            logger.info(f"Detected sphere: {sphere} from topic: {topic_name}")
-            return sphere
+    # The leftmost match is not necessarily the highest-priority keyword
+    keywords = _SPHERE_KEYWORD_RE.findall(topic_name.lower())
+    if keywords:
+        sphere = _SPHERE_KEYWORDS[min(keywords, key=_SPHERE_KEYWORD_RANK.__getitem__)]
+        logger.info(f"Detected sphere: {sphere} from topic: {topic_name}")
+        return sphere
     
     logger.info(f"Could not detect sphere from topic: {topic_name}")
     return None
 
 
+# Topic thread column of each sphere
+_THREAD_COLUMNS = {
+    "soul": User.thread_soul,
+    "body": User.thread_body,
+    "business": User.thread_business,
+    "center": User.thread_center,
+}
+
+
 def update_user_thread(telegram_id: int, sphere: str, thread_id: int, chat_id: int):
     """Update user's thread ID for a specific sphere."""
     logger.info(f"Updating thread for user {telegram_id}, sphere: {sphere}, thread_id: {thread_id}")
     
+    values = {User.chat_id: chat_id}
+    thread_column = _THREAD_COLUMNS.get(sphere)
+    if thread_column is not None:
+        values[thread_column] = thread_id
+    
     with get_session() as session:
-        user = session.query(User).filter(User.telegram_id == telegram_id).first()
-        if not user:
+        # A single UPDATE; no need to load the user first
+        updated = session.query(User).filter(
+            User.telegram_id == telegram_id
+        ).update(values, synchronize_session=False)
+        
+        if not updated:
             logger.warning(f"User not found: {telegram_id}")
             return
         
-        user.chat_id = chat_id
-        
-        if sphere == "soul":
-            user.thread_soul = thread_id
-        elif sphere == "body":
-            user.thread_body = thread_id
-        elif sphere == "business":
-            user.thread_business = thread_id
-        elif sphere == "center":
-            user.thread_center = thread_id
-        
         logger.info(f"Updated thread_{sphere} to {thread_id} for user {telegram_id}")
+    
+    get_sphere_by_thread.cache_clear()
 
 
+@lru_cache(maxsize=4096)
 def get_sphere_by_thread(telegram_id: int, chat_id: int, thread_id: Optional[int]) -> Optional[str]:
-    """Get the sphere associated with a specific thread ID for a user."""
-    logger.info(f"Getting sphere for user {telegram_id}, chat_id: {chat_id}, thread_id: {thread_id}")
+    """
+    Get the sphere associated with a specific thread ID for a user.
     
-    with get_session() as session:
-        user = session.query(User).filter(User.telegram_id == telegram_id).first()
-        if not user:
-            logger.warning(f"User not found: {telegram_id}")
-            return None
-        
-        if user.chat_id != chat_id:
-            logger.debug(f"Chat ID mismatch: expected {user.chat_id}, got {chat_id}")
-            return None
-        
-        if thread_id == user.thread_soul:
-            return "soul"
-        elif thread_id == user.thread_body:
-            return "body"
-        elif thread_id == user.thread_business:
-            return "business"
-        elif thread_id == user.thread_center:
-            return "center"
-        
-        logger.debug(f"No matching thread found for thread_id: {thread_id}")
+    Results are memoized; update_user_thread clears the cache whenever a
+    mapping is written, which is the only place threads change.
+    """
+    logger.info("Getting sphere for user %s, chat_id: %s, thread_id: %s", telegram_id, chat_id, thread_id)
+    
+    with get_read_session() as session:
+        # Only chat_id and the thread columns are needed, not the whole user row
+        row = session.query(User.chat_id, *_THREAD_COLUMNS.values()).filter(
+            User.telegram_id == telegram_id
+        ).first()
+    
+    if not row:
+        logger.warning("User not found: %s", telegram_id)
+        return None
+    
+    user_chat_id, *thread_ids = row
+    if user_chat_id != chat_id:
+        logger.debug("Chat ID mismatch: expected %s, got %s", user_chat_id, chat_id)
         return None
+    
+    for sphere, sphere_thread_id in zip(_THREAD_COLUMNS, thread_ids):
+        if thread_id == sphere_thread_id:
+            return sphere
+    
+    logger.debug("No matching thread found for thread_id: %s", thread_id)
+    return None
 
 
 def get_all_spheres_history(user_id: int) -> str:
@@ -369,18 +406,19 @@ def get_all_spheres_history(user_id: int) -> str:
         ("business", "Дело")
     ]
     
+    # Last 500 messages of every sphere in one round trip instead of one query per sphere
+    with get_read_session() as session:
+        messages_by_sphere = _get_recent_messages_by_sphere(session, user_id, [key for key, _ in spheres])
+    
     history_parts = []
     
     for sphere_key, sphere_name in spheres:
-        messages = get_last_messages(user_id, sphere_key, limit=500)
+        messages = messages_by_sphere.get(sphere_key)
         
         if messages:
-            history_lines = []
-            for msg in messages:
-                role_label = "USER" if msg.role == "user" else "AI"
-                history_lines.append(f"{role_label}: {msg.content}")
-            
-            sphere_history = "\n".join(history_lines)
+            sphere_history = "\n".join(
+                f"{_ALL_SPHERES_ROLE_LABELS.get(msg.role, 'AI')}: {msg.content}" for msg in messages
+            )
             history_parts.append(f"[СФЕРА {sphere_name}]\n{sphere_history}")
     
     result = "\n\n".join(history_parts) if history_parts else "[СФЕРА Штаб]\nno data\n\n[СФЕРА Душа]\nno data\n\n[СФЕРА Тело]\nno data\n\n[СФЕРА Дело]\nno data"
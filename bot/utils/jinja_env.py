@@ -0,0 +1,18 @@
+import os
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+# Content directory path
+CONTENT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "content")
+
+# Compiled template bytecode is kept on disk, so a restart skips the Jinja compile step.
+# Without a directory argument Jinja uses a per-user temp dir that it creates with mode 0700
+# and refuses to use if another user owns it, so nobody else can plant bytecode there.
+bytecode_cache = FileSystemBytecodeCache()
+
+# Shared by the curator and summarization prompts; prompt files never change while the bot runs
+prompt_env = Environment(
+    loader=FileSystemLoader(CONTENT_DIR),
+    auto_reload=False,
+    cache_size=400,
+    bytecode_cache=bytecode_cache
+)
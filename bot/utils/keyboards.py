@@ -0,0 +1,29 @@
+import os
+from functools import lru_cache
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+CURATORS_MESSAGE_TEXT = (
+    "Сейчас тебе нужно выбрать наставников! "
+    "Не волнуйся, ты всегда сможешь изменить свой выбор и выбрать того, кто тебе больше по душе."
+)
+CURATORS_BUTTON_TEXT = "Выбрать наставников"
+
+
+@lru_cache(maxsize=1)
+def _curator_page_url_template() -> str:
+    """Read WEBAPP_URL on first use, after .env has been loaded."""
+    webapp_url = os.getenv("WEBAPP_URL", "http://127.0.0.1:5000")
+    return f"{webapp_url}/curator-choice?user_id={{}}"
+
+
+def get_curator_page_url(telegram_id: int) -> str:
+    """Get the webapp URL of the curator choice page for a user."""
+    return _curator_page_url_template().format(telegram_id)
+
+
+def build_curators_keyboard(curator_page_url: str) -> InlineKeyboardMarkup:
+    """Build the keyboard with the button that opens the curator choice page."""
+    # A plain URL button: web_app buttons would require an HTTPS webapp
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(CURATORS_BUTTON_TEXT, url=curator_page_url)]
+    ])
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Callable, Coroutine, Dict, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket for a single event loop; acquire() waits until a token is free."""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+    
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+    
+    def pause(self, seconds: float):
+        """Stop handing out tokens for the given number of seconds."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+    
+    async def acquire(self):
+        """Wait for and take one token."""
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TokenBucketRateLimiter(BaseRateLimiter[int]):
+    """
+    Keep outgoing requests under Telegram's flood limits.
+    
+    Every request addressed to a chat takes a token from a bot-wide bucket and
+    from that chat's bucket, which refills more slowly for groups. On
+    RetryAfter the affected bucket is paused and the request is retried.
+    
+    A per-call retry limit can be passed as ``rate_limit_args``.
+    """
+    
+    # Telegram allows about 30 messages per second overall, 1 per second per chat
+    # and 20 per minute in a group
+    GLOBAL_RATE = 28
+    CHAT_RATE = 1
+    CHAT_BURST = 3
+    GROUP_RATE = 20 / 60
+    MAX_RETRIES = 3
+    
+    def __init__(self):
+        self._global_bucket = TokenBucket(rate=self.GLOBAL_RATE, capacity=self.GLOBAL_RATE)
+        # An idle chat's bucket is full again after a few seconds, so it can be dropped
+        self._chat_buckets = TTLCache(ttl=60)
+    
+    async def initialize(self):
+        """Nothing to set up."""
+    
+    async def shutdown(self):
+        """Nothing to tear down."""
+    
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Like PTB's AIORateLimiter: @usernames and negative ids are groups or channels
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.GROUP_RATE if is_group else self.CHAT_RATE
+            bucket = TokenBucket(rate=rate, capacity=self.CHAT_BURST)
+        # Re-set on every use so active chats never expire
+        self._chat_buckets.set(chat_id, bucket)
+        return bucket
+    
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Any:
+        chat_id = data.get("chat_id")
+        # Requests not aimed at a chat (callback answers, getFile, ...) are not throttled
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        max_retries = rate_limit_args if rate_limit_args is not None else self.MAX_RETRIES
+        
+        for attempt in range(max_retries + 1):
+            if chat_bucket is not None:
+                await chat_bucket.acquire()
+                await self._global_bucket.acquire()
+            
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    raise
+                
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                
+                logger.warning(f"Rate limited on {endpoint} for chat {chat_id}, retrying in {retry_after}s")
+                if chat_bucket is not None:
+                    chat_bucket.pause(retry_after)
+                else:
+                    await asyncio.sleep(retry_after)
@@ -0,0 +1,65 @@
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from ..database import get_read_session, User
+from ..database.models import _CURATOR_GETTERS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class UserSnapshot:
+    """The few user fields needed on every incoming message."""
+    id: int
+    first_name: Optional[str]
+    selected_center: Optional[str]
+    selected_business: Optional[str]
+    selected_soul: Optional[str]
+    selected_body: Optional[str]
+    
+    def has_all_curators_selected(self) -> bool:
+        """Check if user has selected all required curators."""
+        return all([
+            self.selected_business,
+            self.selected_soul,
+            self.selected_body,
+            self.selected_center
+        ])
+    
+    def get_curator_for_sphere(self, sphere: str) -> Optional[str]:
+        """Get selected curator for a given sphere."""
+        getter = _CURATOR_GETTERS.get(sphere)
+        return getter(self) if getter else None
+
+
+def get_user_snapshot(telegram_id: int) -> Optional[UserSnapshot]:
+    """
+    Load the snapshot of a user with a single narrow SELECT.
+    
+    Curators are selected in the webapp, a separate process, so the row is
+    read on every call rather than cached here; the query touches only the
+    snapshot columns via the telegram_id index.
+    
+    Args:
+        telegram_id: The user's Telegram ID
+        
+    Returns:
+        The user snapshot, or None if the user does not exist
+    """
+    with get_read_session() as session:
+        # Fetch just the snapshot columns instead of hydrating the whole User row
+        row = session.query(
+            User.id,
+            User.first_name,
+            User.selected_center,
+            User.selected_business,
+            User.selected_soul,
+            User.selected_body
+        ).filter(User.telegram_id == telegram_id).first()
+    
+    if not row:
+        logger.debug("User not found for snapshot: %s", telegram_id)
+        return None
+    
+    return UserSnapshot(*row)
@@ -1,16 +1,30 @@
 import os
 import logging
-from flask import Flask, render_template, request, jsonify, send_from_directory
+import hashlib
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, NamedTuple, Optional, Tuple
+from flask import Flask, make_response, render_template, request, jsonify, send_from_directory
 from dotenv import load_dotenv
+from sqlalchemy import bindparam, select, update
 
 # Add parent directory to path for imports
 import sys
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_ROOT = os.path.dirname(_HERE)
+sys.path.insert(0, _ROOT)
 
-from bot.database import get_session, User, init_db
+from bot.database import get_session, get_read_session, User, init_db, engine
+from bot.utils.jinja_env import bytecode_cache
 
 load_dotenv()
 
+# Server settings, resolved once after .env is loaded
+WEBAPP_HOST = os.getenv("EXPRESS_HOST", "127.0.0.1").replace("https://", "").replace("http://", "")
+WEBAPP_PORT = int(os.getenv("EXPRESS_PORT", 5000))
+# The debugger and reloader are opt-in for local development
+WEBAPP_DEBUG = os.getenv("FLASK_DEBUG", "0") == "1"
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -18,36 +32,111 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__, template_folder='templates')
+# Templates only change on deploy, so never stat them on render
+app.config["TEMPLATES_AUTO_RELOAD"] = False
+app.jinja_env.auto_reload = False
+# Compiled template bytecode is kept on disk, so a restarted webapp skips the Jinja compile step
+app.jinja_env.bytecode_cache = bytecode_cache
+# Behind a proxy that understands X-Sendfile, hand asset bodies off to it instead of streaming them here
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "0") == "1"
+# Responses are tiny dicts; skip key sorting and always emit compact JSON
+app.json.sort_keys = False
+app.json.compact = True
+# No endpoint takes uploads; also bounds bodies sent without a Content-Length
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1024
+
+ASSETS_DIR = os.path.join(_ROOT, 'assets')
+
+
+class Curator(NamedTuple):
+    """A curator offered for a sphere on the choice page."""
+    
+    id: str
+    name: str
+    description: str
+    available: bool
 
-# Available curators for each sphere
-CURATORS = {
-    "center": [
-        {"id": "plan", "name": "Развернутый", "description": "системный анализ всех сфер жизни, выявление связей и корневых причин, структурированные планы действий", "available": True},
-        {"id": "vibe", "name": "Краткий", "description": "быстрая координация сфер, короткие ответы по сути, фокус на главном", "available": True}
-    ],
-    "body": [
-        {"id": "plan", "name": "Развернутый", "description": "биохакинг, наука, холистический подход", "available": True},
-        {"id": "vibe", "name": "Краткий", "description": "прямые команды, старая школа", "available": True},
-        {"id": "arnold", "name": "Арнольд Шварценеггер", "description": "силовые тренировки, бодибилдинг, масса", "available": False},
-        {"id": "brus", "name": "Брюс Ли", "description": "скорость, функциональность, боевые искусства, философия движения", "available": False},
-        {"id": "krishna", "name": "Кришнамачарья", "description": "йога, растяжка, мобильность, связь дыхания и тела", "available": False}
-    ],
-    "soul": [
-        {"id": "plan", "name": "Развернутый", "description": "Наставник по глубинной психологии и работе с бессознательным", "available": True},
-        {"id": "vibe", "name": "Краткий", "description": "Наставник по стоической философии и практическим инструментам", "available": True},
-        {"id": "markaryan", "name": "Арсен Маркарян", "description": "практический психолог для распознавания манипуляций, ролей в треугольнике Карпмана и понимания игр во всех отношениях.", "available": False},
-        {"id": "osho", "name": "Ошо", "description": "провокационный учитель медитации и наблюдения для тех, кто хочет отстраниться от отождествления с мыслями и эмоциями.", "available": False},
-        {"id": "avrelii", "name": "Марк Аврелий", "description": "прагматичный стоик с краткими максимами для различения контролируемого от неконтролируемого и принятия реальности без драмы.", "available": False}
-    ],
-    "business": [
-        {"id": "plan", "name": "Развернутый", "description": "аналитик для создания личных принципов работы с деньгами через документирование ошибок, понимание циклов и долгосрочное стратегическое планирование.", "available": True},
-        {"id": "vibe", "name": "Краткий", "description": "фокусировщик на измеримых целях и немедленном действии для всех форматов работы: от найма до бизнеса через приоритизацию и быстрые итерации.", "available": True},
-        {"id": "sandberg", "name": "Шерил Сэндберг", "description": "эксперт по корпоративной карьере, переговорам о зарплате и нетворкингу для тех, кто работает в офисе и хочет расти вертикально.", "available": False},
-        {"id": "chehov", "name": "Антон Павлович Чехов", "description": "наставник для творческих людей по монетизации таланта через множественные каналы: от журналов до театров, от прагматизма к искусству.", "available": False},
-        {"id": "belford", "name": "Джордан Белфорт", "description": "мастер продаж и убеждения для тех, кому нужны деньги здесь и сейчас через бизнес.", "available": False}
-    ],
+
+# Available curators for each sphere; read-only, shared by every request
+CURATORS = MappingProxyType({
+    "center": (
+        Curator(id="plan", name="Развернутый", description="системный анализ всех сфер жизни, выявление связей и корневых причин, структурированные планы действий", available=True),
+        Curator(id="vibe", name="Краткий", description="быстрая координация сфер, короткие ответы по сути, фокус на главном", available=True)
+    ),
+    "body": (
+        Curator(id="plan", name="Развернутый", description="биохакинг, наука, холистический подход", available=True),
+        Curator(id="vibe", name="Краткий", description="прямые команды, старая школа", available=True),
+        Curator(id="arnold", name="Арнольд Шварценеггер", description="силовые тренировки, бодибилдинг, масса", available=False),
+        Curator(id="brus", name="Брюс Ли", description="скорость, функциональность, боевые искусства, философия движения", available=False),
+        Curator(id="krishna", name="Кришнамачарья", description="йога, растяжка, мобильность, связь дыхания и тела", available=False)
+    ),
+    "soul": (
+        Curator(id="plan", name="Развернутый", description="Наставник по глубинной психологии и работе с бессознательным", available=True),
+        Curator(id="vibe", name="Краткий", description="Наставник по стоической философии и практическим инструментам", available=True),
+        Curator(id="markaryan", name="Арсен Маркарян", description="практический психолог для распознавания манипуляций, ролей в треугольнике Карпмана и понимания игр во всех отношениях.", available=False),
+        Curator(id="osho", name="Ошо", description="провокационный учитель медитации и наблюдения для тех, кто хочет отстраниться от отождествления с мыслями и эмоциями.", available=False),
+        Curator(id="avrelii", name="Марк Аврелий", description="прагматичный стоик с краткими максимами для различения контролируемого от неконтролируемого и принятия реальности без драмы.", available=False)
+    ),
+    "business": (
+        Curator(id="plan", name="Развернутый", description="аналитик для создания личных принципов работы с деньгами через документирование ошибок, понимание циклов и долгосрочное стратегическое планирование.", available=True),
+        Curator(id="vibe", name="Краткий", description="фокусировщик на измеримых целях и немедленном действии для всех форматов работы: от найма до бизнеса через приоритизацию и быстрые итерации.", available=True),
+        Curator(id="sandberg", name="Шерил Сэндберг", description="эксперт по корпоративной карьере, переговорам о зарплате и нетворкингу для тех, кто работает в офисе и хочет расти вертикально.", available=False),
+        Curator(id="chehov", name="Антон Павлович Чехов", description="наставник для творческих людей по монетизации таланта через множественные каналы: от журналов до театров, от прагматизма к искусству.", available=False),
+        Curator(id="belford", name="Джордан Белфорт", description="мастер продаж и убеждения для тех, кому нужны деньги здесь и сейчас через бизнес.", available=False)
+    ),
+})
+
+# Lookup sets for validating selections, built once from CURATORS
+VALID_SPHERES = frozenset(CURATORS)
+VALID_CURATOR_IDS = {sphere: frozenset(c.id for c in curators) for sphere, curators in CURATORS.items()}
+
+# Column holding the selected curator of each sphere
+SELECTED_CURATOR_COLUMNS = {
+    "center": User.selected_center,
+    "business": User.selected_business,
+    "soul": User.selected_soul,
+    "body": User.selected_body,
 }
 
+# User columns rendered by the curator choice page
+CURATOR_CHOICE_COLUMNS = (
+    User.telegram_id,
+    User.recommended_center,
+    User.recommended_business,
+    User.recommended_soul,
+    User.recommended_body,
+    User.selected_center,
+    User.selected_business,
+    User.selected_soul,
+    User.selected_body,
+)
+# Compiled once; the statement cache reuses it for every page hit
+CURATOR_CHOICE_QUERY = select(*CURATOR_CHOICE_COLUMNS).where(User.telegram_id == bindparam("telegram_id"))
+
+# Loaded and compiled at startup rather than on the first page hit
+CURATOR_CHOICE_TEMPLATE = app.jinja_env.get_template('curator_choice.html')
+
+# JSON endpoints guarded before dispatch; their bodies are a few hundred bytes at most
+JSON_API_PATHS = frozenset({'/api/select-curator', '/api/select-curators'})
+MAX_JSON_API_BODY = 1024
+
+
+@app.before_request
+def _guard_json_api():
+    """Reject non-JSON or oversized posts to the JSON endpoints before any parsing."""
+    if request.method != 'POST' or request.path not in JSON_API_PATHS:
+        return None
+    
+    if request.mimetype != 'application/json':
+        logger.error(f"Rejected {request.path} request with Content-Type {request.mimetype!r}")
+        return jsonify({"error": "Content-Type must be application/json"}), 415
+    
+    if request.content_length is not None and request.content_length > MAX_JSON_API_BODY:
+        logger.error(f"Rejected {request.path} request with {request.content_length} byte body")
+        return jsonify({"error": "Request body too large"}), 413
+    
+    return None
+
 
 @app.route('/curator-choice')
 def curator_choice():
@@ -65,39 +154,51 @@ def curator_choice():
         logger.error(f"Invalid user_id: {user_id}")
         return "Error: invalid user_id", 400
     
-    # Get user data
-    with get_session() as session:
-        user = session.query(User).filter(User.telegram_id == telegram_id).first()
-        
-        if not user:
-            logger.error(f"User not found: {telegram_id}")
-            return "Error: user not found", 404
-        
-        user_data = {
-            "telegram_id": user.telegram_id,
-            "recommended_center": user.recommended_center,
-            "recommended_business": user.recommended_business,
-            "recommended_soul": user.recommended_soul,
-            "recommended_body": user.recommended_body,
-            "selected_center": user.selected_center,
-            "selected_business": user.selected_business,
-            "selected_soul": user.selected_soul,
-            "selected_body": user.selected_body
-        }
+    # Get user data; a Core select of the columns the page shows, no ORM instance
+    with get_read_session() as session:
+        user_data = session.execute(CURATOR_CHOICE_QUERY, {"telegram_id": telegram_id}).mappings().first()
+    
+    if not user_data:
+        logger.error(f"User not found: {telegram_id}")
+        return "Error: user not found", 404
     
     logger.info(f"Rendering curator choice for user {telegram_id}")
     
-    return render_template(
-        'curator_choice.html',
-        user=user_data,
+    html, etag = _render_curator_choice(tuple(user_data.items()))
+    
+    response = make_response(html)
+    response.set_etag(etag)
+    # Let the browser keep the page, but revalidate every time so a new selection shows at once
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    # Answers 304 without a body when If-None-Match matches
+    return response.make_conditional(request)
+
+
+@lru_cache(maxsize=4096)
+def _render_curator_choice(user_items: tuple) -> Tuple[str, str]:
+    """
+    Render the curator choice page for one user state.
+    
+    The page depends only on these user fields and the static CURATORS, so
+    the key changes by itself when a curator is selected; no invalidation needed.
+    
+    Returns:
+        Tuple of (HTML, ETag derived from the HTML)
+    """
+    html = render_template(
+        CURATOR_CHOICE_TEMPLATE,
+        user=dict(user_items),
         curators=CURATORS
     )
+    return html, hashlib.blake2b(html.encode(), digest_size=8).hexdigest()
 
 
 @app.route('/api/select-curator', methods=['POST'])
 def select_curator():
     """API endpoint to select a curator for a sphere."""
-    data = request.get_json()
+    # Bodies are parsed once, so skip caching them; malformed JSON falls through to the error below
+    data = request.get_json(silent=True, cache=False)
     
     if not data:
         logger.error("No JSON data provided")
@@ -113,67 +214,116 @@ def select_curator():
         logger.error("Missing required fields")
         return jsonify({"error": "Missing required fields: user_id, sphere, curator"}), 400
     
-    # Validate sphere
-    if sphere not in CURATORS:
-        logger.error(f"Invalid sphere: {sphere}")
-        return jsonify({"error": f"Invalid sphere: {sphere}"}), 400
+    error = _selection_error(sphere, curator)
+    if error:
+        return jsonify({"error": error}), 400
     
-    # Validate curator
-    valid_curators = [c["id"] for c in CURATORS[sphere]]
-    if curator not in valid_curators:
-        logger.error(f"Invalid curator {curator} for sphere {sphere}")
-        return jsonify({"error": f"Invalid curator: {curator}"}), 400
+    try:
+        telegram_id = int(telegram_id)
+    except (TypeError, ValueError):
+        logger.error(f"Invalid user_id: {telegram_id}")
+        return jsonify({"error": "Invalid user_id"}), 400
+    
+    if not _store_selections(telegram_id, {sphere: curator}):
+        return jsonify({"error": "User not found"}), 404
+    
+    return jsonify({"success": True, "message": f"Curator {curator} selected for {sphere}"})
+
+
+@app.route('/api/select-curators', methods=['POST'])
+def select_curators():
+    """API endpoint to select curators for several spheres in one request."""
+    # Bodies are parsed once, so skip caching them; malformed JSON falls through to the error below
+    data = request.get_json(silent=True, cache=False)
+    
+    if not data:
+        logger.error("No JSON data provided")
+        return jsonify({"error": "No data provided"}), 400
+    
+    telegram_id = data.get('user_id')
+    selections = data.get('selections')
+    
+    logger.info(f"Select curators request: user={telegram_id}, selections={selections}")
+    
+    if not telegram_id or not selections or not isinstance(selections, dict):
+        logger.error("Missing required fields")
+        return jsonify({"error": "Missing required fields: user_id, selections"}), 400
+    
+    # Validate everything before writing anything
+    for sphere, curator in selections.items():
+        error = _selection_error(sphere, curator)
+        if error:
+            return jsonify({"error": error}), 400
     
     try:
         telegram_id = int(telegram_id)
-    except ValueError:
+    except (TypeError, ValueError):
         logger.error(f"Invalid user_id: {telegram_id}")
         return jsonify({"error": "Invalid user_id"}), 400
     
-    # Update user's selected curator
+    if not _store_selections(telegram_id, selections):
+        return jsonify({"error": "User not found"}), 404
+    
+    return jsonify({"success": True, "message": f"Curators selected for {', '.join(selections)}"})
+
+
+def _selection_error(sphere: str, curator: str) -> Optional[str]:
+    """Validate one sphere/curator pair, returning the error message or None."""
+    # JSON may carry lists or objects, which cannot be looked up in a set
+    if not isinstance(sphere, str) or sphere not in VALID_SPHERES:
+        logger.error(f"Invalid sphere: {sphere}")
+        return f"Invalid sphere: {sphere}"
+    
+    if not isinstance(curator, str) or curator not in VALID_CURATOR_IDS[sphere]:
+        logger.error(f"Invalid curator {curator} for sphere {sphere}")
+        return f"Invalid curator: {curator}"
+    
+    return None
+
+
+def _store_selections(telegram_id: int, selections: Dict[str, str]) -> bool:
+    """Write the selected curators of the given spheres with a single UPDATE; False if the user is unknown."""
     with get_session() as session:
-        user = session.query(User).filter(User.telegram_id == telegram_id).first()
+        result = session.execute(
+            update(User)
+            .where(User.telegram_id == telegram_id)
+            .values({SELECTED_CURATOR_COLUMNS[sphere]: curator for sphere, curator in selections.items()})
+            .execution_options(synchronize_session=False)
+        )
         
-        if not user:
+        if not result.rowcount:
             logger.error(f"User not found: {telegram_id}")
-            return jsonify({"error": "User not found"}), 404
-        
-        if sphere == "center":
-            user.selected_center = curator
-        elif sphere == "business":
-            user.selected_business = curator
-        elif sphere == "soul":
-            user.selected_soul = curator
-        elif sphere == "body":
-            user.selected_body = curator
-        
-        logger.info(f"Updated {sphere} curator to {curator} for user {telegram_id}")
+            return False
     
-    return jsonify({"success": True, "message": f"Curator {curator} selected for {sphere}"})
+    for sphere, curator in selections.items():
+        logger.info(f"Updated {sphere} curator to {curator} for user {telegram_id}")
+    return True
+
+
+# Health checks always answer the same bytes
+HEALTH_BODY = b'{"status":"ok"}\n'
 
 
 @app.route('/health')
 def health():
     """Health check endpoint."""
-    return jsonify({"status": "ok"})
+    # A fresh Response per call; one shared instance could be mutated by Flask's response processing
+    return app.response_class(HEALTH_BODY, mimetype="application/json")
 
 
 @app.route('/assets/<path:filepath>')
 def serve_assets(filepath):
     """Serve static assets from the assets directory."""
-    assets_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets')
-    return send_from_directory(assets_dir, filepath)
+    return send_from_directory(ASSETS_DIR, filepath)
 
 
 def run_webapp():
     """Run the Flask webapp."""
     init_db()
+    logger.info(f"Database pool: {engine.pool.status()}")
     
-    host = os.getenv("EXPRESS_HOST", "127.0.0.1").replace("https://", "").replace("http://", "")
-    port = int(os.getenv("EXPRESS_PORT", 5000))
-    
-    logger.info(f"Starting webapp on {host}:{port}")
-    app.run(host=host, port=port, debug=True)
+    logger.info(f"Starting webapp on {WEBAPP_HOST}:{WEBAPP_PORT} (debug={WEBAPP_DEBUG})")
+    app.run(host=WEBAPP_HOST, port=WEBAPP_PORT, debug=WEBAPP_DEBUG, use_reloader=WEBAPP_DEBUG, threaded=True)
 
 
 if __name__ == '__main__':